@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+=============================
+Online reconstruction latency
+=============================
+
+In this example, we simulate a recording, plan its reconstruction with a
+model, and feed it to an online reconstructor in 10 ms blocks, as a live
+recording would arrive.  We then print the latency of reconstructing each
+block.
+
+"""
+
+# License: MIT
+
+import time
+import numpy as np
+import supereeg as se
+
+# simulate a model and a 1000 Hz recording with 10 of its locations
+locs = se.simulate_locations(n_elecs=100)
+model = se.Model(data=[se.simulate_model_bos(n_samples=100, sample_rate=1000, locs=locs,
+                                             sample_locs=10) for x in range(3)], locs=locs)
+bo = se.simulate_model_bos(n_samples=10000, sample_rate=1000, locs=locs, sample_locs=10)
+
+# the reconstruction operator is computed once, here
+online = se.OnlineReconstructor(model, bo, nearest_neighbor=False)
+
+# use the first second to initialize the running statistics
+data = bo.data.values
+online.calibrate(data[:1000])
+
+# reconstruct the rest in 10 ms (10 sample) blocks
+latency = []
+for start in range(1000, data.shape[0], 10):
+    t = time.time()
+    recon = online.update(data[start:start + 10])
+    latency.append(time.time() - t)
+
+latency = np.multiply(latency, 1000)
+print('Reconstructed locations: ' + str(recon.shape[1]))
+print('Block latency in ms (median, 99th percentile, max): ' +
+      str(np.percentile(latency, [50, 99, 100])))
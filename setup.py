@@ -27,7 +27,7 @@ setup(
         'numpy>=1.10.4',
         'nilearn>=0.4.1',
         'nibabel',
-        'joblib',
+        'joblib>=0.12',
         'imageio',
         'future',
         'hypertools',
@@ -1,6 +1,7 @@
 from .brain import Brain
 from .model import Model
 from .nifti import Nifti
+from .plan import PredictionPlan, OnlineReconstructor
 from .load import load
 from .simulate import *
 from .helpers import model_compile, sort_unique_locs, tal2mni
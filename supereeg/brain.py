@@ -5,15 +5,22 @@ import os
 import warnings
 import copy
 import six
+from collections import namedtuple
 import numpy as np
 import pandas as pd
 import nibabel as nib
 import deepdish as dd
 import matplotlib.pyplot as plt
 from scipy.stats import zscore
-from .helpers import _kurt_vals, _normalize_Y, _vox_size, _resample, _plot_locs_connectome, \
+from .helpers import _kurt_vals, _data_block, _session_codes, _session_offsets, _session_chunks, \
+    _index_length, _read_only, _normalize_Y, _vox_size, _resample, _plot_locs_connectome, \
     _plot_locs_hyp, _std, _gray, _nifti_to_brain, _brain_to_nifti
 
+
+# a block of samples of a brain object (see Brain.iter_chunks)
+BrainChunk = namedtuple('BrainChunk', ['data', 'start', 'session', 'sample_rate'])
+
+
 class Brain(object):
     """
     Brain data object for the supereeg package
@@ -60,14 +67,16 @@ class Brain(object):
     ----------
 
     data : pandas.DataFrame
-        Samples x electrodes dataframe containing the EEG data.
+        Samples x electrodes dataframe containing the EEG data.  The data are
+        held as a numpy array (float32 or float64, not copied if passed in as
+        such), which the dataframe wraps without copying.
 
     locs : pandas.DataFrame
         Electrode by MNI coordinate (x,y,z) df containing electrode locations.
 
     sessions : pandas.Series
         Samples x 1 array containing session identifiers.  If a single value is passed, a single session will be
-        created.
+        created.  Sessions are held as integer codes, from which the series is built.
 
     sample_rates : list
         Sample rate of the data. If different over multiple sessions, this is a list.
@@ -100,6 +109,12 @@ class Brain(object):
     maximum_voxel_size : positive scalar or 3D numpy array
         Used to construct Nifti objects; default: 20 (mm)
 
+    n_jobs : int
+        Number of processes used to compute the electrodes' kurtosis (one
+        session per process).  Unless passed in, kurtosis is computed the first
+        time it is needed, and again only after data is replaced.  Default 1;
+        -1 uses all cpus.
+
 
     Returns
     ----------
@@ -112,7 +127,7 @@ class Brain(object):
     def __init__(self, data=None, locs=None, sessions=None, sample_rate=None,
                  meta=None, date_created=None, label=None, kurtosis=None,
                  kurtosis_threshold=10, minimum_voxel_size=3, maximum_voxel_size=20,
-                 filter='kurtosis'):
+                 filter='kurtosis', n_jobs=1):
 
         from .load import load, datadict
         from .model import Model
@@ -124,7 +139,6 @@ class Brain(object):
 
         if isinstance(data, Brain):
             self.__dict__.update(data.__dict__)
-            self.update_filter_inds()
             self.update_info()
             self = data
 
@@ -138,27 +152,19 @@ class Brain(object):
                     data = np.divide(data.numerator, data.denominator)
                 np.fill_diagonal(data, 1)
 
-            if isinstance(data, pd.DataFrame):
-                self.data = data
-            else:
-                self.data = pd.DataFrame(data)
-
-            if isinstance(locs, pd.DataFrame):
-                assert all(locs.columns == ['x', 'y', 'z'])
-                self.locs = locs
-            else:
-                self.locs = pd.DataFrame(locs, columns=['x', 'y', 'z'])
+            self.data = data
+            self.locs = locs
 
             if isinstance(sessions, str) or isinstance(sessions, int):
-                self.sessions = pd.Series([sessions for i in range(self.data.shape[0])])
+                self.sessions = np.repeat(sessions, self._values.shape[0])
 
             elif sessions is None:
-                self.sessions = pd.Series([1 for i in range(self.data.shape[0])])
+                self.sessions = np.ones(self._values.shape[0], dtype=np.int64)
             else:
-                self.sessions = pd.Series(sessions.ravel())
+                self.sessions = sessions
 
             if type(sample_rate) in [int, float]:
-                self.sample_rate = [sample_rate]*len(self.sessions.unique())
+                self.sample_rate = [sample_rate]*len(self._session_ids)
             elif isinstance(sample_rate, list):
                 if isinstance(sample_rate[0], np.ndarray):
                     if sample_rate[0].ndim == 1:
@@ -175,19 +181,19 @@ class Brain(object):
                     self.sample_rate = list(sample_rate[0])
                 elif np.shape(sample_rate)[1] == 1:
                     self.sample_rate = [sample_rate[0]]
-                assert len(self.sample_rate) ==  len(self.sessions.unique()), \
+                assert len(self.sample_rate) ==  len(self._session_ids), \
                     'Should be one sample rate for each session.'
             else:
                 self.sample_rate = None
 
-                if self.data.shape[0] == 1:
+                if self._values.shape[0] == 1:
                     self.n_secs = 0
                 else:
                     self.n_secs = None
                     warnings.warn('No sample rate given.  Number of seconds cant be computed')
 
             if sample_rate is not None:
-                index, counts = np.unique(self.sessions, return_counts=True)
+                counts = np.bincount(self._session_codes)
                 self.n_secs = np.true_divide(counts, np.array(sample_rate))
 
             if meta:
@@ -200,18 +206,16 @@ class Brain(object):
             else:
                 self.date_created = date_created
 
-            self.n_elecs = self.data.shape[1] # needs to be calculated by sessions
-            self.n_sessions = len(self.sessions.unique())
+            self.n_elecs = self._values.shape[1] # needs to be calculated by sessions
+            self.n_sessions = len(self._session_ids)
+            self.n_jobs = n_jobs
             if np.iterable(kurtosis):
                 self.kurtosis = kurtosis
-            else:
-                self.kurtosis = _kurt_vals(self)
             self.kurtosis_threshold = kurtosis_threshold
             self.filter=filter
-            self.filter_inds = self.update_filter_inds()
 
             if not label:
-                self.label = len(self.locs) * ['observed']
+                self.label = len(self._locs_values) * ['observed']
             else:
                 self.label = label
 
@@ -231,7 +235,7 @@ class Brain(object):
         return self
 
     def __next__(self):
-        if self.counter >= self.data.shape[0]:
+        if self.counter >= self._values.shape[0]:
             raise StopIteration
         s = self[self.counter]
         self.counter+=1
@@ -240,15 +244,83 @@ class Brain(object):
     def next(self):
         return self.__next__()
 
-    def update_filter_inds(self):
+    @property
+    def data(self):
+        """Samples x electrodes dataframe of the EEG data, built (without copying) from the data block"""
+        if self._data_frame is None:
+            self._data_frame = pd.DataFrame(self._values, copy=False)
+        return self._data_frame
+
+    @data.setter
+    def data(self, value):
+        self._values = _data_block(value)
+        self._data_frame = None
+        self._kurtosis = None
+        self._filter_cache = {}
+
+    @property
+    def sessions(self):
+        """Session identifier of each sample, built from the session codes"""
+        if self._sessions_series is None:
+            self._sessions_series = pd.Series(self._session_ids[self._session_codes])
+        return self._sessions_series
+
+    @sessions.setter
+    def sessions(self, value):
+        self._session_codes, self._session_ids = _session_codes(value)
+        self._session_offsets = _session_offsets(self._session_codes)
+        self._sessions_series = None
+        self._kurtosis = None
+        self._filter_cache = {}
+
+    @property
+    def locs(self):
+        """Electrode by MNI coordinate (x,y,z) df containing electrode locations"""
+        if self._locs_frame is None:
+            self._locs_frame = pd.DataFrame(self._locs_values, columns=['x', 'y', 'z'])
+        return self._locs_frame
+
+    @locs.setter
+    def locs(self, value):
+        if isinstance(value, pd.DataFrame):
+            assert all(value.columns == ['x', 'y', 'z'])
+        if value is None:
+            self._locs_values = np.empty((0, 3))
+        else:
+            self._locs_values = np.asarray(value, dtype=np.float64).reshape(-1, 3)
+        self._locs_frame = None
+        self._filter_cache = {}
+
+    @property
+    def kurtosis(self):
+        """Maximum kurtosis across sessions of each electrode, computed when first needed"""
+        if self._kurtosis is None:
+            self._kurtosis = _kurt_vals(self, n_jobs=self.n_jobs)
+        return self._kurtosis
+
+    @kurtosis.setter
+    def kurtosis(self, value):
+        self._kurtosis = value
+        self._filter_cache = {}
+
+    @property
+    def filter_inds(self):
+        """Electrodes that pass the filter"""
         if self.filter == 'kurtosis':
-            self.filter_inds = self.kurtosis <= self.kurtosis_threshold
+            return self.kurtosis <= self.kurtosis_threshold
         else:
-            self.filter_inds = np.ones((1, self.locs.shape[0]), dtype=np.bool) #TODO: check this
+            return np.ones((1, self._locs_values.shape[0]), dtype=np.bool) #TODO: check this
+
+    def update_filter_inds(self):
+        """
+        Returns the electrodes that pass the filter.  filter_inds is computed
+        whenever it is accessed, so this need not be called first.
+        """
+        return self.filter_inds
 
     def update_info(self):
-        self.n_elecs = self.data.shape[1] # needs to be calculated by sessions
-        self.n_sessions = len(self.sessions.unique())
+        self.n_elecs = self._values.shape[1] # needs to be calculated by sessions
+        self.n_sessions = len(self._session_ids)
         try:
             self.n_secs = np.true_divide(counts, np.array(sample_rate))
         except:
@@ -270,38 +342,148 @@ class Brain(object):
         print('Meta data: ' + str(self.meta))
 
     def get_filtered_bo(self):
-        """ Return a filtered copy """
-        x = self.__dict__
-        x['data'] = self.get_data()
-        x['locs'] = self.get_locs()
-        x['kurtosis'] = x['kurtosis'][x['kurtosis'] <= x['kurtosis_threshold']]
-        for key in ['n_subs', 'n_elecs', 'n_sessions', 'filter_inds', 'n_secs']:
-            if key in x.keys():
-                x.pop(key)
-        bo = Brain(**x)
+        """
+        Return a filtered copy
+
+        The copy shares the (cached) filtered data and their z-scores with
+        this brain object, and keeps its kurtosis if it has been computed.
+        Unless filter is 'kurtosis', kurtosis is not computed.
+        """
+        inds = self.filter_inds.ravel()
+        kurtosis = None if self._kurtosis is None else np.asarray(self._kurtosis)[inds]
+        bo = Brain(data=self._get_values(), locs=self.get_locs(),
+                   sessions=self._session_ids[self._session_codes],
+                   sample_rate=self.sample_rate, meta=self.meta, date_created=self.date_created,
+                   label=np.array(self.label)[inds].tolist(), kurtosis=kurtosis,
+                   kurtosis_threshold=self.kurtosis_threshold, minimum_voxel_size=self.minimum_voxel_size,
+                   maximum_voxel_size=self.maximum_voxel_size, filter=self.filter, n_jobs=self.n_jobs)
+        zscore_key = ('zscore', self.filter, self.kurtosis_threshold)
+        if zscore_key in self._filter_cache:
+            bo._filter_cache[zscore_key] = self._filter_cache[zscore_key]
         bo.update_info()
         return bo
 
     def get_data(self):
         """
         Gets data from brain object
+
+        The filtered data are cached until data, locs, kurtosis, filter or
+        kurtosis_threshold change, and are a view of data (not a copy) when
+        the electrodes that pass the filter are contiguous.  The returned
+        dataframe is new on each call and its data are read-only, so modifying
+        it cannot change the brain object.
         """
-        self.update_filter_inds()
-        return self.data.iloc[:, self.filter_inds.ravel()]
+        return pd.DataFrame(self._get_values(), copy=False)
 
     def get_zscore_data(self):
         """
         Gets zscored data from brain object
+
+        The zscored data are cached as get_data's are, and are read-only.
         """
-        self.update_filter_inds()
-        return zscore(self.get_data())
+        return self._filtered('zscore', lambda: _read_only(zscore(self._get_values())))
 
     def get_locs(self):
         """
         Gets locations from brain object
+
+        The filtered locations are cached as get_data's are, and a copy is
+        returned.
+        """
+        return self._filtered('locs', lambda: self.locs.iloc[self._filter_cols(), :]).copy()
+
+    def iter_sessions(self, filtered=True):
         """
-        self.update_filter_inds()
-        return self.locs.iloc[self.filter_inds.ravel(), :]
+        Iterates over the data of each session
+
+        When each session's samples are contiguous (see _session_offsets), the
+        blocks are read-only views of the data rather than copies.
+
+        Parameters
+        ----------
+        filtered : bool
+            If True (default), blocks hold the electrodes that pass the filter
+            (as get_data).  Otherwise, they hold all electrodes.
+
+        Returns
+        ----------
+        results : generator
+            Generator of (session, samples x electrodes numpy array) tuples, in
+            order of the sessions' first samples
+
+        """
+        values = self._get_values() if filtered else _read_only(self._values.view())
+        codes = self._session_codes
+        for code, rows in _session_chunks(codes, max(len(codes), 1), offsets=self._session_offsets):
+            yield self._session_ids[code], values[rows]
+
+    def iter_chunks(self, chunk_size=1000, step=None, filtered=True):
+        """
+        Iterates over blocks of samples, within each session
+
+        Unlike iterating over the brain object itself, which builds a brain
+        object for every sample, this yields lightweight chunks whose data are
+        views of the data (when each session's samples are contiguous), so
+        recordings of any length can be streamed through reconstruction,
+        filtering or feature extraction.
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of samples per chunk (default 1000).  The last chunk of each
+            session may be shorter.
+
+        step : int or None
+            Number of samples between the starts of consecutive chunks.  If
+            None (default), step is chunk_size, so chunks do not overlap.  A
+            smaller step gives overlapping windows.
+
+        filtered : bool
+            If True (default), chunks hold the electrodes that pass the filter
+            (as get_data).  Otherwise, they hold all electrodes (as expected by
+            OnlineReconstructor.update).
+
+        Returns
+        ----------
+        results : generator
+            Generator of BrainChunk(data, start, session, sample_rate) named
+            tuples: the chunk's samples x electrodes (read-only) numpy array,
+            the index of its first sample, and its session and sample rate
+
+        """
+        step = step or chunk_size
+        values = self._get_values() if filtered else _read_only(self._values.view())
+        codes = self._session_codes
+        for code, rows in _session_chunks(codes, max(len(codes), 1), offsets=self._session_offsets):
+            session = self._session_ids[code]
+            sample_rate = self.sample_rate[code] if self.sample_rate else None
+            n = _index_length(rows, len(codes))
+            for i in range(0, n, step):
+                j = min(i + chunk_size, n)
+                if isinstance(rows, slice):
+                    yield BrainChunk(values[rows.start + i:rows.start + j], rows.start + i, session, sample_rate)
+                else:
+                    yield BrainChunk(values[rows[i:j]], int(rows[i]), session, sample_rate)
+                if j == n:
+                    break
+
+    def _get_values(self):
+        """Filtered data block (a read-only view of the data block when possible), as get_data"""
+        return self._filtered('values', lambda: _read_only(self._values[:, self._filter_cols()]))
+
+    def _filtered(self, name, compute):
+        """Returns the cached result of compute() for the current filter"""
+        key = (name, self.filter, self.kurtosis_threshold)
+        if key not in self._filter_cache:
+            self._filter_cache[key] = compute()
+        return self._filter_cache[key]
+
+    def _filter_cols(self):
+        """Indices of the electrodes that pass the filter, as a slice if they are contiguous"""
+        cols = np.where(self.filter_inds.ravel())[0]
+        if len(cols) > 0 and cols[-1] - cols[0] + 1 == len(cols):
+            return slice(cols[0], cols[-1] + 1)
+        return cols
 
     def get_slice(self, sample_inds=None, loc_inds=None, inplace=False):
         """
@@ -319,25 +501,33 @@ class Brain(object):
             If True, indexes in place.
 
         """
+        filtered = np.where(self.filter_inds.ravel())[0]
         if sample_inds is None:
-            sample_inds = list(range(self.get_data().shape[0]))
+            sample_inds = slice(None)
         if loc_inds is None:
-            loc_inds = list(range(self.get_locs().shape[0]))
+            loc_inds = list(range(len(filtered)))
         if isinstance(sample_inds, int):
             sample_inds = [sample_inds]
         if isinstance(loc_inds, int):
             loc_inds = [loc_inds]
 
-        data = self.get_data().iloc[sample_inds, loc_inds]
-        sessions = self.sessions.iloc[sample_inds]
+        # index the raw data once, so memory mapped data are only read for the
+        # requested samples
+        data = self._values[sample_inds][:, filtered[loc_inds]]
+        sessions = self._session_ids[self._session_codes[sample_inds]]
         if self.sample_rate:
             sample_rate = [self.sample_rate[int(s-1)] for s in
-                           sessions.unique()]
+                           pd.unique(sessions)]
         else:
             sample_rate = self.sample_rate
         meta = copy.copy(self.meta)
         locs = self.get_locs().iloc[loc_inds]
         date_created = self.date_created
+        # the kurtosis of the whole recording, if it has been computed
+        if self._kurtosis is not None:
+            kurtosis = np.asarray(self._kurtosis)[filtered[loc_inds]]
+        else:
+            kurtosis = None
 
         if inplace:
             self.data = data
@@ -350,10 +540,10 @@ class Brain(object):
         else:
             return Brain(data=data, locs=locs, sessions=sessions,
                          sample_rate=sample_rate, meta=meta,
-                         date_created=date_created, kurtosis=self.kurtosis,
+                         date_created=date_created, kurtosis=kurtosis,
                          filter=None) #TODO: make sure we preserve all other parameters/properties
 
-    def resample(self, resample_rate=None):
+    def resample(self, resample_rate=None, anti_alias=False):
         """
         Resamples data
 
@@ -361,13 +551,21 @@ class Brain(object):
         Parameters
         ----------
         resample_rate : int or float
-            Desired sample rate
+            Desired sample rate.  If its ratio to a session's sample rate has a
+            denominator over 1000, the closest such ratio is used, and the
+            session's sample_rate is set to the resulting rate.
+
+        anti_alias : bool
+            If True, data are resampled with a polyphase filter that low-pass
+            filters them first, so downsampling does not alias.  Otherwise
+            (default), each session is interpolated with a piecewise cubic
+            hermite polynomial.
 
         """
         if resample_rate is None:
             return self
         else:
-            data, sessions, sample_rate = _resample(self, resample_rate)
+            data, sessions, sample_rate = _resample(self, resample_rate, anti_alias=anti_alias)
             self.data = data
             self.sessions = sessions
             self.sample_rate = sample_rate
@@ -467,7 +665,8 @@ class Brain(object):
 
         filepath : str
 
-            Path to save the nifti file
+            Path to save the nifti file.  Uncompressed (.nii) files are written
+            through a memory map, so the image need not fit in memory
 
         template : str, Nifti1Image, or None
 
@@ -552,12 +751,7 @@ class Brain(object):
             warnings.warn('Voxel sizes of reconstruction and template do not match. '
                           'Voxel sizes calculated from model locations.')
 
-        nifti = _brain_to_nifti(self, img)
-
-        if filepath:
-            nifti.to_filename(filepath)
-
-        return nifti
+        return _brain_to_nifti(self, img, filepath=filepath or None)
 
 
     def save(self, fname, compression='blosc'):
@@ -578,11 +772,13 @@ class Brain(object):
         compression : str
             The kind of compression to use.  See the deepdish documentation for
             options: http://deepdish.readthedocs.io/en/latest/api_io.html#deepdish.io.save
+            If None, the data can be memory mapped straight from the file
+            (see supereeg.load with mmap_mode).
 
         """
 
         bo = {
-            'data': self.data.as_matrix(),
+            'data': self._values,
             'locs': self.locs,
             'sessions': self.sessions,
             'sample_rate': self.sample_rate,
@@ -3,8 +3,15 @@ from __future__ import print_function
 
 import multiprocessing
 import copy
+import time
+import hashlib
+import heapq
 import os
 import warnings
+from functools import reduce
+from fractions import Fraction
+from collections import OrderedDict
+import six
 import numpy.matlib as mat
 import pandas as pd
 import numpy as np
@@ -18,8 +25,11 @@ from nilearn.input_data import NiftiMasker
 from scipy.stats import kurtosis, zscore, pearsonr
 from scipy.spatial.distance import pdist
 from scipy.spatial.distance import cdist
-from scipy.spatial.distance import squareform
+from scipy.spatial import cKDTree
 from scipy import linalg
+from scipy import sparse
+from scipy import signal
+from scipy.interpolate import PchipInterpolator
 from scipy.ndimage.interpolation import zoom
 from joblib import Parallel, delayed
 
@@ -158,49 +168,82 @@ def _apply_by_file_index(bo, xform, aggregator):
 
     """
 
-    for idx, session in enumerate(bo.sessions.unique()):
-        if idx is 0:
-            results = xform(bo.get_data().as_matrix()[bo.sessions == session, :])
+    for idx, (session, data) in enumerate(bo.iter_sessions()):
+        if idx == 0:
+            results = xform(data)
         else:
-            results = aggregator(results, xform(bo.get_data().as_matrix()[bo.sessions == session, :]))
+            results = aggregator(results, xform(data))
 
     return results
 
 
-def _kurt_vals(bo):
+def _kurt_vals(bo, chunk_size=10000, n_jobs=1):
     """
     Function that calculates maximum kurtosis values for each channel
 
+    The data are read in chunks of at most chunk_size samples per session, so
+    memory mapped data are never loaded all at once.  Each session's central
+    moments are merged over its chunks in a single pass.
+
     Parameters
     ----------
     bo : Brain object
         Contains data
 
+    chunk_size : int
+        Number of samples read at a time
+
+    n_jobs : int
+        Number of processes used, each handling whole sessions (default 1).
+        -1 uses all cpus.
+
     Returns
     ----------
     results: 1D ndarray
         Maximum kurtosis across sessions for each channel
 
     """
-    sessions = bo.sessions.unique()
-    results = list(map(lambda s: kurtosis(bo.data[(s==bo.sessions).values]), sessions))
-    return np.max(np.vstack(results), axis=0)
+    data = bo._values
+    sessions = OrderedDict()
+    for session, rows in _session_chunks(bo._session_codes, chunk_size, offsets=bo._session_offsets):
+        sessions.setdefault(session, []).append(rows)
+    if n_jobs == 1 or len(sessions) < 2:
+        stats = [_session_kurt_stats(data, rows) for rows in sessions.values()]
+    else:
+        stats = Parallel(n_jobs=n_jobs)(delayed(_session_kurt_stats)(data, rows) for rows in sessions.values())
+    return np.max(np.vstack([_kurt_from_stats(x) for x in stats]), axis=0)
 
-    # def aggregate(prev, next):
-    #     return np.max(np.vstack((prev, next)), axis=0)
-    #
-    # return _apply_by_file_index(bo, kurtosis, aggregate)
 
+def _session_kurt_stats(data, chunks):
+    """
+    Merges the _kurt_stats of the given chunks of data's samples
+    """
+    stats = None
+    for rows in chunks:
+        stats = _merge_kurt_stats(stats, _kurt_stats(data[rows]))
+    return stats
 
-def _get_corrmat(bo):
+
+def _get_corrmat(bo, chunk_size=10000, dtype=np.float64):
     """
     Function that calculates the average subject level correlation matrix for brain object across session
 
+    Each session's sample count, means and cross products are accumulated in a
+    single pass over the data, at most chunk_size samples at a time, so memory
+    mapped data are never loaded all at once.
+
     Parameters
     ----------
     bo : Brain object
         Contains data
 
+    chunk_size : int
+        Number of samples read at a time
+
+    dtype : numpy dtype
+        Precision of the cross products within each chunk (e.g. np.float32 to
+        halve the memory and double the speed).  Chunks are accumulated in
+        float64.
 
     Returns
     ----------
@@ -208,16 +251,146 @@ def _get_corrmat(bo):
         The average correlation matrix across sessions
 
     """
+    data = bo._values
+    elecs = np.where(bo.filter_inds.ravel())[0]
+    if len(elecs) == data.shape[1]:
+        elecs = slice(None)
+    stats = {}
+    for session, rows in _session_chunks(bo._session_codes, chunk_size, offsets=bo._session_offsets):
+        stats[session] = _merge_cov_stats(stats.get(session), _cov_stats(data[rows][:, elecs], dtype=dtype))
 
-    def aggregate(p, n):
-        return p + n
+    summed_zcorrs = 0
+    for n, mean, M in stats.values():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sd = np.sqrt(np.diag(M))
+            summed_zcorrs = summed_zcorrs + _r2z(M / np.outer(sd, sd))
+
+    return _z2r(summed_zcorrs / len(stats))
+
+
+def _read_only(x):
+    """
+    Flags a numpy array as read-only (views of it then are too) and returns it
+    """
+    x.setflags(write=False)
+    return x
+
+
+def _data_block(data):
+    """
+    Returns data as a samples x electrodes numpy array
+
+    float32 and float64 data (including memory mapped data) are not copied;
+    other data are converted to float64.
+
+    Parameters
+    ----------
+    data : numpy.ndarray or pandas.DataFrame
+        Samples x electrodes data
+
+    Returns
+    ----------
+    results : numpy.ndarray
+        Samples x electrodes data block
+
+    """
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        data = data.values
+    data = np.asarray(data)
+    if data.dtype not in (np.float32, np.float64):
+        data = data.astype(np.float64)
+    if data.ndim < 2:
+        data = data.reshape(-1, 1)
+    return data
+
+
+def _session_codes(sessions):
+    """
+    Integer code of each sample's session, and the session identifiers
+
+    Parameters
+    ----------
+    sessions : pandas.Series or numpy.ndarray
+        Session identifier of each sample
+
+    Returns
+    ----------
+    results : tuple
+        (codes, identifiers): codes number the sessions in order of first
+        appearance, and identifiers[codes] gives back the sessions
+
+    """
+    codes, uniques = pd.factorize(np.asarray(sessions).ravel())
+    return codes.astype(np.int64), np.asarray(uniques)
 
-    def zcorr(x):
-        return _r2z(1 - squareform(pdist(x.T, 'correlation')))
 
-    summed_zcorrs = _apply_by_file_index(bo, zcorr, aggregate)
+def _session_offsets(codes):
+    """
+    Start and stop offsets of each session's samples
 
-    return _z2r(summed_zcorrs / len(bo.sessions.unique()))
+    Parameters
+    ----------
+    codes : numpy.ndarray
+        Session code of each sample (see _session_codes)
+
+    Returns
+    ----------
+    results : numpy.ndarray or None
+        Session i's samples are offsets[i]:offsets[i + 1].  None if some
+        session's samples are not contiguous.
+
+    """
+    codes = np.asarray(codes)
+    if len(codes) == 0:
+        return np.zeros(1, dtype=np.int64)
+    # codes number sessions in order of first appearance, so they only
+    # decrease where a session's samples resume after another session's
+    if np.any(np.diff(codes) < 0):
+        return None
+    return np.searchsorted(codes, np.arange(codes[-1] + 2))
+
+
+def _session_chunks(sessions, chunk_size=10000, offsets=None):
+    """
+    Splits each session's samples into chunks
+
+    Parameters
+    ----------
+    sessions : pandas.Series or numpy.ndarray
+        Session identifier of each sample
+
+    chunk_size : int
+        Maximum number of samples per chunk
+
+    offsets : numpy.ndarray or None
+        Session offsets (see _session_offsets) of session codes.  If given,
+        sessions are taken to be those codes, and the chunks are sliced
+        straight from the offsets.
+
+    Returns
+    ----------
+    results : generator
+        Generator of (session, sample indices) tuples.  The indices are a
+        slice when the session's samples are contiguous, so indexing with them
+        gives a view rather than a copy.
+
+    """
+    if offsets is not None:
+        for i in range(len(offsets) - 1):
+            for start in range(offsets[i], offsets[i + 1], chunk_size):
+                yield i, slice(start, min(start + chunk_size, offsets[i + 1]))
+        return
+    codes, uniques = pd.factorize(np.asarray(sessions).ravel())
+    order = np.argsort(codes, kind='mergesort')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    for i, session in enumerate(uniques):
+        inds = order[bounds[i]:bounds[i + 1]]
+        contiguous = inds[-1] - inds[0] + 1 == len(inds)
+        for start in range(0, len(inds), chunk_size):
+            if contiguous:
+                yield session, slice(inds[0] + start, inds[0] + min(start + chunk_size, len(inds)))
+            else:
+                yield session, inds[start:start + chunk_size]
 
 
 def _z_score(bo):
@@ -286,7 +459,49 @@ def _r2z(r):
         return 0.5 * (np.log(1 + r) - np.log(1 - r))
 
 
-def _rbf(x, center, width=20):
+def _pack_triu(x):
+    """
+    Packs the upper triangle (including the diagonal) of a symmetric matrix
+
+    Parameters
+    ----------
+    x : ndarray
+        Symmetric n x n matrix
+
+    Returns
+    ----------
+    result : ndarray
+        1D array of length n * (n + 1) / 2 holding the upper triangle, row by
+        row
+
+    """
+    return x[np.triu_indices(x.shape[0])]
+
+
+def _unpack_triu(packed):
+    """
+    Unpacks a symmetric matrix packed by _pack_triu
+
+    Parameters
+    ----------
+    packed : ndarray
+        1D array holding the upper triangle of a symmetric matrix, row by row
+
+    Returns
+    ----------
+    result : ndarray
+        Symmetric n x n matrix
+
+    """
+    n = int(np.round((np.sqrt(8 * len(packed) + 1) - 1) / 2))
+    rows, cols = np.triu_indices(n)
+    x = np.empty((n, n), dtype=packed.dtype)
+    x[rows, cols] = packed
+    x[cols, rows] = packed
+    return x
+
+
+def _rbf(x, center, width=20, cutoff=None, eps=None):
     """
     Radial basis function
 
@@ -301,13 +516,37 @@ def _rbf(x, center, width=20):
     width : int
         Radius
 
+    cutoff : int, float or None
+        If given, weights between coordinates further apart than cutoff are
+        treated as zero and a scipy.sparse matrix is returned.  Default None
+        (dense weights).
+
+    eps : float or None
+        Alternative to cutoff: truncate weights smaller than eps.  Ignored if
+        cutoff is given.
+
     Returns
     ----------
-    results : ndarray
+    results : ndarray or scipy.sparse.csr_matrix
         Matrix of _rbf weights for each subject coordinate for all coordinates
 
     """
-    return np.exp(-cdist(x, center, metric='euclidean') ** 2 / float(width))
+    if cutoff is None and eps is not None:
+        if not 0 < eps < 1:
+            raise ValueError('Please set eps between 0 and 1.')
+        cutoff = np.sqrt(-float(width) * np.log(eps))
+    if cutoff is not None and not cutoff > 0:
+        raise ValueError('Please set cutoff to a positive distance.')
+
+    if cutoff is None:
+        return np.exp(-cdist(x, center, metric='euclidean') ** 2 / float(width))
+
+    x = np.asarray(x, dtype=np.float64)
+    center = np.asarray(center, dtype=np.float64)
+    d = cKDTree(x).sparse_distance_matrix(cKDTree(center), cutoff, output_type='coo_matrix')
+    weights = sparse.coo_matrix((np.exp(-d.data ** 2 / float(width)), (d.row, d.col)),
+                                shape=(x.shape[0], center.shape[0]))
+    return weights.tocsr()
 
 
 def tal2mni(r):
@@ -361,7 +600,7 @@ def _uniquerows(x):
     return x[idx]
 
 
-def _expand_corrmat_fit(C, weights):
+def _expand_corrmat_fit(C, weights, engine='vectorized'):
     """
     Gets full correlation matrix
 
@@ -373,9 +612,10 @@ def _expand_corrmat_fit(C, weights):
     weights : Numpy array
         Weights matrix calculated using _rbf function matrix
 
-    mode : str
-        Specifies whether to compute over all elecs (fit mode) or just new elecs
-        (predict mode)
+    engine : 'vectorized' or 'loop'
+        If 'vectorized' (default), the expansion is computed in closed form with
+        matrix products.  If 'loop', the (much slower) pairwise loop over model
+        locations is used.  Both engines give the same result.
 
     Returns
     ----------
@@ -385,9 +625,18 @@ def _expand_corrmat_fit(C, weights):
         Denominator for the expanded correlation matrix
     """
 
+    if engine not in ('vectorized', 'loop',):
+        raise ValueError('Please set engine to either vectorized or loop.')
+
     C[np.eye(C.shape[0]) == 1] = 0
     C[np.where(np.isnan(C))] = 0
 
+    if engine == 'vectorized':
+        return _expand_corrmat_closed_form(C, weights)
+
+    if sparse.issparse(weights):
+        weights = weights.toarray()
+
     n = weights.shape[0]
     K = np.zeros([n, n])
     W = np.zeros([n, n])
@@ -411,7 +660,51 @@ def _expand_corrmat_fit(C, weights):
     return (K + K.T), (W + W.T)
 
 
-def _expand_corrmat_predict(C, weights):
+def _expand_corrmat_closed_form(Z, weights):
+    """
+    Closed form of the pairwise expansion used by _expand_corrmat_fit
+
+    For model locations x > y, the loop engine sums the strictly lower
+    triangular part of outer(weights[x], weights[y]), weighted by Z.  That is
+    weights[x] . L . weights[y] (with L the strictly lower triangle of ones, or
+    of Z for the numerator), so the whole matrix is weights . L . weights.T,
+    keeping only the entries below the diagonal.
+
+    Parameters
+    ----------
+    Z : Numpy array
+        Subject's z-transformed correlation matrix, with zeros on the diagonal
+
+    weights : Numpy array or scipy.sparse matrix
+        Weights matrix calculated using _rbf function matrix.  If sparse, it is
+        only ever multiplied with dense (model locations x subject locations)
+        arrays, so no dense copy of it is made.
+
+    Returns
+    ----------
+    numerator : Numpy array
+        Numerator for the expanded correlation matrix
+    denominator : Numpy array
+        Denominator for the expanded correlation matrix
+
+    """
+    L = np.tril(np.ones(Z.shape), -1)
+
+    if sparse.issparse(weights):
+        weights = weights.tocsr()
+        K = np.tril(weights.dot(np.asarray(weights.dot(np.tril(Z, -1))).T).T, -1)
+        W = np.tril(weights.dot(np.asarray(weights.dot(L)).T).T, -1)
+        return (K + K.T), (W + W.T)
+
+    weights = np.asarray(weights, dtype=np.float64)
+
+    K = np.tril(np.dot(np.dot(weights, np.tril(Z, -1)), weights.T), -1)
+    W = np.tril(np.dot(np.dot(weights, L), weights.T), -1)
+
+    return (K + K.T), (W + W.T)
+
+
+def _expand_corrmat_predict(C, weights, engine='tiled', n_jobs=1, tile_size=256):
     """
     Gets full correlation matrix
 
@@ -420,12 +713,21 @@ def _expand_corrmat_predict(C, weights):
     C : Numpy array
         Subject's correlation matrix
 
-    weights : Numpy array
+    weights : Numpy array or scipy.sparse matrix
         Weights matrix calculated using _rbf function matrix
 
-    mode : str
-        Specifies whether to compute over all elecs (fit mode) or just new elecs
-        (predict mode)
+    engine : 'tiled' or 'loop'
+        If 'tiled' (default), blocks of new location rows are computed at once
+        with matrix products.  If 'loop', one task is dispatched per pair of
+        locations.  Both engines give the same result.
+
+    n_jobs : int
+        Number of parallel jobs (default 1).  -1 uses all cpus.  The tiled
+        engine runs its tiles in threads that share the input arrays.
+
+    tile_size : int
+        Number of new location rows computed per tile by the tiled engine
+        (default 256)
 
     Returns
     ----------
@@ -436,6 +738,9 @@ def _expand_corrmat_predict(C, weights):
 
     """
 
+    if engine not in ('tiled', 'loop',):
+        raise ValueError('Please set engine to either tiled or loop.')
+
     C[np.eye(C.shape[0]) == 1] = 0
     C[np.where(np.isnan(C))] = 0
 
@@ -445,9 +750,28 @@ def _expand_corrmat_predict(C, weights):
     Z = C
 
     s = C.shape[0]
+
+    if engine == 'tiled':
+        if sparse.issparse(weights):
+            weights = weights.tocsr()
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+        # computed as (weights . tril.T).T so that sparse weights stay on the left
+        ZLw = np.asarray(weights.dot(np.tril(Z, -1).T)).T
+        Lw = np.asarray(weights.dot(np.tril(np.ones(Z.shape), -1).T)).T
+        tiles = [(x, min(x + tile_size, n)) for x in range(s, n, tile_size)]
+
+        Parallel(n_jobs=n_jobs, require='sharedmem')(
+            delayed(_compute_tile)(tile, weights, ZLw, Lw, K, W) for tile in tiles)
+
+        return (K + K.T), (W + W.T)
+
+    if sparse.issparse(weights):
+        weights = weights.toarray()
+
     sliced_up = [(x, y) for x in range(s, n) for y in range(x)]
 
-    results = Parallel(n_jobs=multiprocessing.cpu_count())(
+    results = Parallel(n_jobs=n_jobs)(
         delayed(_compute_coord)(coord, weights, Z) for coord in sliced_up)
 
     W[[x[0] for x in sliced_up], [x[1] for x in sliced_up]] = [x[0] for x in results]
@@ -462,6 +786,37 @@ def _compute_coord(coord, weights, Z):
     return np.sum(next_weights), np.sum(Z * next_weights)
 
 
+def _compute_tile(tile, weights, ZLw, Lw, K, W):
+    """
+    Fills rows start:stop (columns below the diagonal) of K and W in place
+
+    Parameters
+    ----------
+    tile : tuple
+        (start, stop) rows of the expanded matrix to compute
+
+    weights : Numpy array or scipy.sparse.csr_matrix
+        Weights matrix calculated using _rbf function matrix
+
+    ZLw : Numpy array
+        Strictly lower triangle of the subject's correlation matrix times weights.T
+
+    Lw : Numpy array
+        Strictly lower triangle of ones times weights.T
+
+    K : Numpy array
+        Numerator (filled in place)
+
+    W : Numpy array
+        Denominator (filled in place)
+
+    """
+    start, stop = tile
+    below_diag = np.tril(np.ones((stop - start, stop)), start - 1)
+    K[start:stop, :stop] = np.asarray(weights[start:stop].dot(ZLw[:, :stop])) * below_diag
+    W[start:stop, :stop] = np.asarray(weights[start:stop].dot(Lw[:, :stop])) * below_diag
+
+
 def _chunk_bo(bo, chunk):
     """
     Chunk brain object by session for reconstruction. Returns chunked indices
@@ -484,7 +839,7 @@ def _chunk_bo(bo, chunk):
     return bo.get_slice(sample_inds=[i for i in chunk if i is not None])
 
 
-def _timeseries_recon(bo, K, chunk_size=1000, preprocess='zscore'):
+def _timeseries_recon(bo, K, chunk_size=1000, preprocess='zscore', proj=None, reg=0):
     """
     Reconstruction done by chunking by session
 
@@ -499,6 +854,14 @@ def _timeseries_recon(bo, K, chunk_size=1000, preprocess='zscore'):
     chunk_size : int
         Size to break data into
 
+    proj : Numpy.ndarray or None
+        Precomputed projection operator Kba . pinv(Kaa) (see _recon_projection).
+        If None (default), it is computed from K.
+
+    reg : int or float
+        Regularization added to the diagonal of Kaa when computing the
+        projection (default 0)
+
     Returns
     ----------
     results : ndarray
@@ -506,28 +869,396 @@ def _timeseries_recon(bo, K, chunk_size=1000, preprocess='zscore'):
 
     """
     if preprocess==None:
-        data = bo.get_data().as_matrix()
+        data = bo._get_values()
     elif preprocess=='zscore':
-        if bo.data.shape[0]<3:
+        if bo._values.shape[0]<3:
             warnings.warn('Not enough samples to zscore so it will be skipped.'
             ' Note that this will cause problems if your data are not already '
             'zscored.')
-            data = bo.get_data().as_matrix()
+            data = bo._get_values()
         else:
             data = bo.get_zscore_data()
 
-    s = K.shape[0] - data.shape[1]
-    Kba = K[:s, s:]
-    Kaa = K[s:, s:]
-    Kaa_inv = np.linalg.pinv(Kaa)
-    sessions = bo.sessions.unique()
-    chunks = [np.array(i) for session in sessions for i in _chunker(bo.sessions[bo.sessions == session].index.tolist(), chunk_size)]
-    chunks = list(map(lambda x: np.array(x[x != np.array(None)], dtype=np.int8), chunks))
-    # results = np.vstack(Parallel(n_jobs=multiprocessing.cpu_count())(
-    #     delayed(_reconstruct_activity)(data[chunk, :], Kba, Kaa_inv) for chunk in chunks))
-    results = np.vstack(list(map(lambda x: _reconstruct_activity(data[x, :], Kba, Kaa_inv), chunks)))
-    zresults = list(map(lambda s: zscore(results[bo.sessions==s, :]), sessions))
-    return np.hstack([np.vstack(zresults), data])
+    if proj is None:
+        proj = _recon_projection(K, data.shape[1], reg=reg)
+    codes, offsets = bo._session_codes, bo._session_offsets
+    results = np.empty((data.shape[0], proj.shape[0] + data.shape[1]))
+    recon = results[:, :proj.shape[0]]
+    for session, rows in _session_chunks(codes, chunk_size, offsets=offsets):
+        recon[rows] = np.dot(data[rows], proj.T)
+    for session, rows in _session_chunks(codes, max(len(codes), 1), offsets=offsets):
+        recon[rows] = zscore(recon[rows])
+    results[:, proj.shape[0]:] = data
+    return results
+
+
+def _recon_projection(K, n_observed, reg=0):
+    """
+    Computes the reconstruction operator Kba . pinv(Kaa)
+
+    Kaa is symmetric, so its pseudo-inverse is taken from an eigendecomposition
+    rather than an SVD.  If reg > 0, reg is added to the diagonal of Kaa and the
+    system is solved with a Cholesky factorization instead.
+
+    Parameters
+    ----------
+    K : Numpy.ndarray
+        Correlation matix including observed and predicted locations, with the
+        observed locations in the last n_observed rows/columns
+
+    n_observed : int
+        Number of observed locations
+
+    reg : int or float
+        Regularization added to the diagonal of Kaa (default 0)
+
+    Returns
+    ----------
+    results : ndarray
+        Reconstructed locations x observed locations projection matrix
+
+    """
+    s = K.shape[0] - n_observed
+    return _block_projection(K[:s, s:], K[s:, s:], reg=reg)
+
+
+def _block_projection(Kba, Kaa, reg=0):
+    """
+    Computes Kba . pinv(Kaa) (see _recon_projection) from the two blocks
+    """
+    if reg:
+        Kaa = Kaa + reg * np.eye(Kaa.shape[0])
+        try:
+            return linalg.cho_solve(linalg.cho_factor(Kaa), Kba.T).T
+        except linalg.LinAlgError:
+            pass
+
+    vals, vecs = linalg.eigh(Kaa)
+    keep = np.abs(vals) > 1e-15 * np.max(np.abs(vals))
+    vecs = vecs[:, keep]
+    return np.dot(np.dot(Kba, vecs) / vals[keep], vecs.T)
+
+
+def _low_rank_projection(vecs_b, vecs_a, vals, reg=0):
+    """
+    Computes the reconstruction operator Kba . pinv(Kaa) from a low-rank
+    factorization K = vecs . diag(vals) . vecs.T of the correlation matrix
+
+    Only the observed x observed and reconstructed x observed blocks are
+    formed, so memory grows with the number of locations times the rank or the
+    number of observed locations, never with the square of the number of
+    locations.  As in the dense case, the diagonal of Kaa is zeroed.
+
+    Parameters
+    ----------
+    vecs_b : Numpy.ndarray
+        Factor rows of the reconstructed locations
+
+    vecs_a : Numpy.ndarray
+        Factor rows of the observed locations
+
+    vals : Numpy.ndarray
+        Weight of each factor
+
+    reg : int or float
+        Regularization added to the diagonal of Kaa (default 0)
+
+    Returns
+    ----------
+    results : ndarray
+        Reconstructed locations x observed locations projection matrix
+
+    """
+    weighted_a = vecs_a * vals
+    Kaa = np.dot(weighted_a, vecs_a.T)
+    np.fill_diagonal(Kaa, 0)
+    Kba = np.dot(vecs_b, weighted_a.T)
+    return _block_projection(Kba, Kaa, reg=reg)
+
+
+def _low_rank_factors(C, rank, method='eig', n_oversamples=10, n_iter=4, random_state=None):
+    """
+    Low-rank factorization of a symmetric matrix, keeping the rank eigenpairs
+    of largest magnitude
+
+    Parameters
+    ----------
+    C : Numpy.ndarray
+        Symmetric matrix
+
+    rank : int
+        Number of factors kept
+
+    method : 'eig' or 'randomized'
+        'eig' uses a full eigendecomposition.  'randomized' projects C onto a
+        randomized estimate of its range (of size rank + n_oversamples, refined
+        with n_iter power iterations) and decomposes that.
+
+    random_state : int, RandomState or None
+        Seed for the randomized method
+
+    Returns
+    ----------
+    results : tuple
+        (vecs, vals) such that C ~ vecs . diag(vals) . vecs.T
+
+    """
+    rank = min(rank, C.shape[0])
+    if method == 'eig':
+        vals, vecs = linalg.eigh(C)
+    elif method == 'randomized':
+        if isinstance(random_state, np.random.RandomState):
+            rng = random_state
+        else:
+            rng = np.random.RandomState(random_state)
+        Q = rng.normal(size=(C.shape[0], min(rank + n_oversamples, C.shape[0])))
+        for i in range(n_iter + 1):
+            Q, _ = linalg.qr(np.dot(C, Q), mode='economic')
+        vals, U = linalg.eigh(np.dot(Q.T, np.dot(C, Q)))
+        vecs = np.dot(Q, U)
+    else:
+        raise ValueError("Please set method to 'eig' or 'randomized'.")
+
+    keep = np.argsort(np.abs(vals))[::-1][:rank]
+    return vecs[:, keep], vals[keep]
+
+
+def _nystrom_factors(C_cols, landmarks, rank):
+    """
+    Nystrom factorization of a symmetric matrix from a subset of its columns
+
+    C ~ C[:, L] . pinv(C[L, L]) . C[:, L].T, where pinv(C[L, L]) keeps the rank
+    eigenpairs of C[L, L] of largest magnitude.
+
+    Parameters
+    ----------
+    C_cols : Numpy.ndarray
+        Columns of C at the landmark locations
+
+    landmarks : Numpy.ndarray
+        Indices of the landmark locations
+
+    rank : int
+        Number of factors kept
+
+    Returns
+    ----------
+    results : tuple
+        (vecs, vals) such that C ~ vecs . diag(vals) . vecs.T
+
+    """
+    vals, U = linalg.eigh(C_cols[landmarks])
+    keep = np.argsort(np.abs(vals))[::-1][:rank]
+    keep = keep[np.abs(vals[keep]) > 1e-15 * np.max(np.abs(vals))]
+    return np.dot(C_cols, U[:, keep]), 1. / vals[keep]
+
+
+def _timeseries_recon_stream(read_chunk, sessions, proj, chunk_size=1000, preprocess='zscore'):
+    """
+    Reconstruction done chunk by chunk, without holding the data in memory
+
+    A first pass over the chunks collects each session's mean and covariance of
+    the observed data.  These give the z-scoring of the observed data and, since
+    the reconstruction is linear, each session's mean and standard deviation of
+    the reconstructed data.  A second pass then reconstructs and z-scores each
+    chunk, giving the same result as _timeseries_recon.
+
+    Parameters
+    ----------
+    read_chunk : function
+        read_chunk(start, stop) returns samples start:stop of the observed data
+        (samples x observed locations)
+
+    sessions : numpy.ndarray
+        Session identifier of each sample
+
+    proj : Numpy.ndarray
+        Projection operator Kba . pinv(Kaa) (see _recon_projection)
+
+    chunk_size : int
+        Number of samples read at a time
+
+    preprocess : 'zscore' or None
+        Whether to z-score the observed data within each session
+
+    Returns
+    ----------
+    results : generator
+        Generator of (start sample, reconstructed chunk) tuples.  Each chunk
+        has the reconstructed locations followed by the observed locations.
+
+    """
+    sessions = np.asarray(sessions).ravel()
+    n_samples = sessions.shape[0]
+    if preprocess == 'zscore' and n_samples < 3:
+        warnings.warn('Not enough samples to zscore so it will be skipped.'
+                      ' Note that this will cause problems if your data are not already '
+                      'zscored.')
+        preprocess = None
+    bounds = [(start, min(start + chunk_size, n_samples)) for start in range(0, n_samples, chunk_size)]
+
+    stats = {}
+    for start, stop in bounds:
+        Y = read_chunk(start, stop)
+        for s in np.unique(sessions[start:stop]):
+            stats[s] = _merge_cov_stats(stats.get(s), _cov_stats(Y[sessions[start:stop] == s]))
+
+    n, mean, M = reduce(_merge_cov_stats, stats.values())
+    if preprocess == 'zscore':
+        shift, scale = mean, np.sqrt(np.diag(M) / n)
+    else:
+        shift, scale = np.zeros_like(mean), np.ones_like(mean)
+
+    recon_scales = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for s, (n, mean, M) in stats.items():
+            cov = M / n / np.outer(scale, scale)
+            recon_mean = np.dot(proj, (mean - shift) / scale)
+            recon_std = np.sqrt(np.sum(np.dot(proj, cov) * proj, axis=1))
+            recon_scales[s] = (recon_mean, recon_std)
+
+    def chunks():
+        for start, stop in bounds:
+            Y = read_chunk(start, stop)
+            results = np.empty((stop - start, proj.shape[0] + proj.shape[1]))
+            for s in np.unique(sessions[start:stop]):
+                recon_mean, recon_std = recon_scales[s]
+                inds = sessions[start:stop] == s
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    Ys = (Y[inds] - shift) / scale
+                    results[inds, :proj.shape[0]] = (np.dot(Ys, proj.T) - recon_mean) / recon_std
+                results[inds, proj.shape[0]:] = Ys
+            yield start, results
+
+    return chunks()
+
+
+def _cov_stats(X, dtype=np.float64):
+    """
+    Sample count, column means and centered cross products of X
+
+    Parameters
+    ----------
+    X : Numpy.ndarray
+        Samples x features array
+
+    dtype : numpy dtype
+        Precision of the computation; the results are returned in float64
+
+    Returns
+    ----------
+    results : tuple
+        (n, mean, M) where M is the features x features sum of centered cross
+        products
+
+    """
+    X = np.asarray(X, dtype=dtype)
+    mean = np.mean(X, axis=0)
+    Xc = X - mean
+    return X.shape[0], mean.astype(np.float64), np.dot(Xc.T, Xc).astype(np.float64)
+
+
+def _merge_cov_stats(a, b):
+    """
+    Merges two sets of _cov_stats (pairwise update of Chan et al.)
+
+    Parameters
+    ----------
+    a : tuple or None
+        Statistics of the first block of samples.  If None, b is returned.
+
+    b : tuple
+        Statistics of the second block of samples
+
+    Returns
+    ----------
+    results : tuple
+        Statistics of both blocks together
+
+    """
+    if a is None:
+        return b
+    n_a, mean_a, M_a = a
+    n_b, mean_b, M_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, M_a + M_b + np.outer(delta, delta) * n_a * n_b / n
+
+
+def _kurt_stats(X):
+    """
+    Sample count, column means and centered power sums (orders 2 to 4) of X
+
+    Parameters
+    ----------
+    X : Numpy.ndarray
+        Samples x features array
+
+    Returns
+    ----------
+    results : tuple
+        (n, mean, M2, M3, M4)
+
+    """
+    X = np.asarray(X, dtype=np.float64)
+    mean = np.mean(X, axis=0)
+    Xc = X - mean
+    Xc2 = Xc ** 2
+    return X.shape[0], mean, np.sum(Xc2, axis=0), np.sum(Xc2 * Xc, axis=0), np.sum(Xc2 ** 2, axis=0)
+
+
+def _merge_kurt_stats(a, b):
+    """
+    Merges two sets of _kurt_stats (pairwise update of Pebay)
+
+    Parameters
+    ----------
+    a : tuple or None
+        Statistics of the first block of samples.  If None, b is returned.
+
+    b : tuple
+        Statistics of the second block of samples
+
+    Returns
+    ----------
+    results : tuple
+        Statistics of both blocks together
+
+    """
+    if a is None:
+        return b
+    n_a, mean_a, M2_a, M3_a, M4_a = a
+    n_b, mean_b, M2_b, M3_b, M4_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    M2 = M2_a + M2_b + delta ** 2 * n_a * n_b / n
+    M3 = M3_a + M3_b + delta ** 3 * n_a * n_b * (n_a - n_b) / n ** 2 + 3 * delta * (n_a * M2_b - n_b * M2_a) / n
+    M4 = M4_a + M4_b + delta ** 4 * n_a * n_b * (n_a ** 2 - n_a * n_b + n_b ** 2) / n ** 3 + \
+         6 * delta ** 2 * (n_a ** 2 * M2_b + n_b ** 2 * M2_a) / n ** 2 + 4 * delta * (n_a * M3_b - n_b * M3_a) / n
+    return n, mean_a + delta * n_b / n, M2, M3, M4
+
+
+def _kurt_from_stats(stats):
+    """
+    Kurtosis (Fisher, biased, as scipy.stats.kurtosis) from _kurt_stats
+
+    Parameters
+    ----------
+    stats : tuple
+        (n, mean, M2, M3, M4)
+
+    Returns
+    ----------
+    results : 1D ndarray
+        Kurtosis of each feature
+
+    """
+    n, mean, M2, _, M4 = stats
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # constant channels have no defined kurtosis
+        zero = M2 / n <= (np.finfo(np.float64).eps * mean) ** 2
+        return np.where(zero, np.nan, n * M4 / M2 ** 2) - 3
+
 
 def _chunker(iterable, chunksize, fillvalue=None):
     """
@@ -556,7 +1287,7 @@ def _chunker(iterable, chunksize, fillvalue=None):
     return list(zip_longest(*args, fillvalue=fillvalue))
 
 
-def _reconstruct_activity(Y, Kba, Kaa_inv):
+def _reconstruct_activity(Y, proj):
     """
     Reconstruct activity
 
@@ -565,11 +1296,7 @@ def _reconstruct_activity(Y, Kba, Kaa_inv):
     Y : numpy array
         brain object with zscored data
 
-    Kba : correlation matrix (unknown to known)
-
-    Kaa_inv : inverse correlation matrix (known to known)
-
-    zscore = False
+    proj : projection matrix Kba . pinv(Kaa) (unknown to known)
 
     Returns
     ----------
@@ -577,7 +1304,7 @@ def _reconstruct_activity(Y, Kba, Kaa_inv):
         Reconstructed timeseries
 
     """
-    return np.atleast_2d(np.squeeze(np.dot(np.dot(Kba, Kaa_inv), Y.T).T))
+    return np.atleast_2d(np.squeeze(np.dot(proj, Y.T).T))
 
 def _round_it(locs, places): #TODO: do we need a separate function for this?  doesn't seem much more convenient than the np.round function...
     """
@@ -703,59 +1430,134 @@ def _normalize_Y(Y_matrix): #TODO: should be part of bo.get_data and/or Brain.__
     return pd.DataFrame(Y)
 
 
-def _fullfact(dims):
-    '''
-    Replicates MATLAB's _fullfact function (behaves the same way)
-    '''
-    vals = np.asmatrix(list(range(1, dims[0] + 1))).T
-    if len(dims) == 1:
-        return vals
-    else:
-        aftervals = np.asmatrix(_fullfact(dims[1:]))
-        inds = np.asmatrix(np.zeros((np.prod(dims), len(dims))))
-        row = 0
-        for i in range(aftervals.shape[0]):
-            inds[row:(row + len(vals)), 0] = vals
-            inds[row:(row + len(vals)), 1:] = np.tile(aftervals[i, :], (len(vals), 1))
-            row += len(vals)
-        return inds
-
-
-def model_compile(data):
+def model_compile(data, fname=None, n_jobs=1, block_size=1000, compression='blosc'):
     """
     Compile existing expanded correlation matrices.
 
+    Only the numerator, denominator, n_subs and locs of each model file are
+    read, and the numerator and denominator are read and summed in blocks of
+    block_size rows, each block in its own process when n_jobs > 1.  The
+    models must share locations (checked by hashing each model's locs), and
+    must all be packed or all be unpacked (see Model).
+
     Parameters
     ----------
     data : list of model object file directories
         Compiles model objects
 
+    fname : str or None
+        If given, the compiled model is written to this file block by block,
+        rather than held in memory, and its path is returned.  If the file
+        extension (.mo) is not specified, it will be appended.
+
+    n_jobs : int
+        Number of processes used to sum blocks (default 1).  -1 uses all cpus.
+
+    block_size : int
+        Number of rows of the numerator and denominator read at a time
+
+    compression : str or None
+        Compression used for the numerator and denominator when writing to
+        fname (default 'blosc')
+
     Returns
     ----------
-    model : Model object
-        A new updated model object
+    model : Model object or str
+        A new updated model object (or the path to it, if fname is given)
 
     """
-    from .load import load
+    import deepdish as dd
+    import tables
     from .model import Model
 
-    m = load(data[0])
-    numerator = m.numerator
-    denominator = m.denominator
-    n_subs = 1
-
-    for mo in data[1:]:
-        m = load(mo)
-        # numerator = np.nansum(np.dstack((numerator, m.numerator)), 2)
-        numerator += m.numerator
-        denominator += m.denominator
-        n_subs += 1
-
-    return Model(numerator=numerator, denominator=denominator,
-                 locs=m.locs, n_subs=n_subs)
-    ### this concatenation of locations doesn't work when updating an existing model (but would be necessary for a build)
-    # return Model(numerator=numerator, denominator=denominator,
-    #              locs=pd.concat([m.locs, bo.locs]), n_subs=n_subs)
+    locs = dd.io.load(data[0], group='/locs') #FIXME: use os.path.join rather than using slashes
+    locs_hash = _locs_hash(locs)
+    n_subs = 0
+    shapes = set()
+    dtypes = []
+    for mo in data:
+        if _locs_hash(dd.io.load(mo, group='/locs')) != locs_hash: #FIXME: use os.path.join rather than using slashes
+            raise ValueError('Locations of ' + str(mo) + ' do not match those of ' + str(data[0]))
+        n_subs += dd.io.load(mo, group='/n_subs') #FIXME: use os.path.join rather than using slashes
+        with tables.open_file(mo, mode='r') as f:
+            node = f.get_node('/numerator')
+            shapes.add(tuple(int(x) for x in node.shape))
+            dtypes.append(node.dtype)
+    if len(shapes) > 1:
+        raise ValueError('Models must either all be packed or all be unpacked.')
+
+    # packed models are summed as contiguous segments of their 1D upper triangles
+    shape = shapes.pop()
+    dtype = np.result_type(*dtypes)
+    n = shape[0]
+    if len(shape) == 1:
+        block_size = block_size * locs.shape[0]
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+    if fname is None:
+        numerator = np.zeros(shape, dtype=dtype)
+        denominator = np.zeros(shape, dtype=dtype)
+        for (start, stop), num_block, denom_block in _sum_model_blocks(data, blocks, n_jobs):
+            numerator[start:stop] = num_block
+            denominator[start:stop] = denom_block
+        return Model(numerator=numerator, denominator=denominator,
+                     locs=locs, n_subs=n_subs)
+
+    if fname[-3:] != '.mo':
+        fname += '.mo'
+    dd.io.save(fname, {'locs': locs, 'n_subs': n_subs, 'meta': None,
+                       'date_created': time.strftime("%c")}, compression=compression)
+    filters = tables.Filters(complib=compression, complevel=5) if compression else None
+    with tables.open_file(fname, mode='a') as f:
+        atom = tables.Atom.from_dtype(dtype)
+        num_node = f.create_carray('/', 'numerator', atom=atom, shape=shape, filters=filters)
+        denom_node = f.create_carray('/', 'denominator', atom=atom, shape=shape, filters=filters)
+        for (start, stop), num_block, denom_block in _sum_model_blocks(data, blocks, n_jobs):
+            num_node[start:stop] = num_block
+            denom_node[start:stop] = denom_block
+    return fname
+
+
+def _sum_model_blocks(data, blocks, n_jobs=1):
+    """
+    Yields (block, numerator rows, denominator rows) summed over the model
+    files in data, computing n_jobs blocks at a time
+    """
+    if n_jobs == 1:
+        for block in blocks:
+            yield (block,) + _sum_model_block(data, block)
+        return
+
+    batch_size = n_jobs if n_jobs > 0 else multiprocessing.cpu_count()
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for start in range(0, len(blocks), batch_size):
+            batch = blocks[start:start + batch_size]
+            results = parallel(delayed(_sum_model_block)(data, block) for block in batch)
+            for block, (num_block, denom_block) in zip(batch, results):
+                yield block, num_block, denom_block
+
+
+def _sum_model_block(data, block):
+    """
+    Sums rows (or, for packed models, elements) block[0] to block[1] of the
+    numerators and denominators of the model files in data
+    """
+    import deepdish as dd
+
+    start, stop = block
+    numerator = 0
+    denominator = 0
+    for mo in data:
+        numerator = numerator + dd.io.load(mo, group='/numerator', sel=dd.aslice[start:stop]) #FIXME: use os.path.join rather than using slashes
+        denominator = denominator + dd.io.load(mo, group='/denominator', sel=dd.aslice[start:stop]) #FIXME: use os.path.join rather than using slashes
+    return numerator, denominator
+
+
+def _locs_hash(locs):
+    """
+    Returns a hash of a set of locations, used to check that models match
+    """
+    return hashlib.md5(np.ascontiguousarray(np.asarray(locs, dtype=np.float64)).tobytes()).hexdigest()
 
 
 def _near_neighbor(bo, mo, match_threshold='auto'): #TODO: should this be part of bo.get_locs() or Brain.__init__, or possibly model.__init__?
@@ -792,31 +1594,102 @@ def _near_neighbor(bo, mo, match_threshold='auto'): #TODO: should this be part o
 
     """
 
-    nbo = copy.deepcopy(bo) #FIXME: copying is expensive...
-    nbo.orig_locs = nbo.locs
-    d = cdist(nbo.locs, mo.locs, metric='Euclidean')
-    for i in range(len(nbo.locs)):
-        min_ind = list(zip(*np.where(d == d.min())))[0]
-        nbo.locs.iloc[min_ind[0], :] = mo.locs.iloc[min_ind[1], :]
-        d[min_ind[0]] = np.inf
-        d[:, min_ind[1]] = np.inf
-    if not match_threshold is 0 or None:
+    locs = np.asarray(bo.locs, dtype=np.float64)
+    model_locs = np.asarray(mo.locs, dtype=np.float64)
+    match = _greedy_match(locs, model_locs)
+    matched = match >= 0
+    new_locs = locs.copy()
+    new_locs[matched] = model_locs[match[matched]]
+
+    # shallow copy: the data block is shared rather than copied
+    nbo = copy.copy(bo)
+    nbo.orig_locs = bo.locs
+    nbo.locs = pd.DataFrame(new_locs, index=bo.locs.index, columns=bo.locs.columns)
 
-        if match_threshold is 'auto':
-            v_size = _vox_size(mo.locs)
-            thresh_bool = abs(nbo.locs - bo.locs) > v_size
-            thresh_bool = thresh_bool.any(1).ravel()
+    if match_threshold is not None and match_threshold != 0:
+        if match_threshold == 'auto':
+            thresh = _vox_size(mo.locs)
         else:
-            thresh_bool = abs(nbo.locs - bo.locs) > match_threshold
-            thresh_bool = thresh_bool.any(1).ravel()
             assert match_threshold > 0, 'Negative Euclidean distances are not allowed'
-        nbo.data = nbo.data.loc[:, ~thresh_bool]
-        nbo.locs = nbo.locs.loc[~thresh_bool, :]
-        nbo.n_elecs = nbo.data.shape[1]
-        nbo.kurtosis = nbo.kurtosis[~thresh_bool]
-        return nbo
-    else:
-        return nbo
+            thresh = match_threshold
+        thresh_bool = (np.abs(new_locs - locs) > np.ravel(thresh)).any(1)
+        if thresh_bool.any():
+            kurtosis = nbo.kurtosis[~thresh_bool]
+            nbo.data = nbo._values[:, ~thresh_bool]
+            nbo.locs = nbo.locs.iloc[~thresh_bool, :]
+            nbo.kurtosis = kurtosis
+        nbo.n_elecs = nbo._values.shape[1]
+    return nbo
+
+
+def _greedy_match(locs, model_locs):
+    """
+    Matches each electrode to a distinct model location, repeatedly pairing the
+    closest unmatched electrode and model location (ties go to the lower
+    electrode index)
+
+    Each electrode's candidates are drawn in order of distance from a KD-tree
+    of the model locations, so the full electrodes x model distance matrix is
+    never formed.
+
+    Parameters
+    ----------
+    locs : numpy.ndarray
+        Electrode locations
+
+    model_locs : numpy.ndarray
+        Model locations
+
+    Returns
+    ----------
+    match : numpy.ndarray
+        Index of the model location matched to each electrode (-1 if there are
+        more electrodes than model locations and the electrode is unmatched)
+
+    """
+    n_model = model_locs.shape[0]
+    match = -np.ones(locs.shape[0], dtype=np.int64)
+    if n_model == 0 or locs.shape[0] == 0:
+        return match
+
+    tree = cKDTree(model_locs)
+    k = min(n_model, 8)
+    dists, inds = tree.query(locs, k=k)
+    dists = dists.reshape(locs.shape[0], -1)
+    inds = inds.reshape(locs.shape[0], -1)
+    candidates = [[dists[i], inds[i], 0] for i in range(locs.shape[0])]
+    taken = np.zeros(n_model, dtype=bool)
+
+    def next_free(i):
+        d, j, pos = candidates[i]
+        while True:
+            while pos < len(j) and taken[j[pos]]:
+                pos += 1
+            if pos < len(j):
+                candidates[i][2] = pos
+                return d[pos], j[pos]
+            if len(j) == n_model:
+                return None
+            # the electrode's nearest model locations are all taken: look further
+            kk = min(n_model, 2 * len(j))
+            d, j = tree.query(locs[i], k=kk)
+            d, j = np.atleast_1d(d), np.atleast_1d(j)
+            candidates[i] = [d, j, pos]
+
+    heap = [(dists[i, 0], i, inds[i, 0]) for i in range(locs.shape[0])]
+    heapq.heapify(heap)
+    n_left = n_model
+    while heap and n_left:
+        d, i, j = heapq.heappop(heap)
+        if taken[j]:
+            nxt = next_free(i)
+            if nxt is not None:
+                heapq.heappush(heap, (nxt[0], i, nxt[1]))
+            continue
+        match[i] = j
+        taken[j] = True
+        n_left -= 1
+    return match
 
 
 def _vox_size(locs):
@@ -894,7 +1767,54 @@ def _count_overlapping(X, Y):
 
     """
 
-    return np.sum([(X.locs == y).all(1) for idy, y in Y.locs.iterrows()], 0).astype(bool)
+    return _overlap_index(X.locs, Y.locs)[0]
+
+
+def _overlap_index(x, y):
+    """
+    Finds overlapping locations in both directions with a single index of the
+    rows of x and y
+
+    Parameters
+    ----------
+    x : ndarray or pandas DataFrame
+        Locations
+
+    y : ndarray or pandas DataFrame
+        Locations
+
+    Returns
+    ----------
+    x_mask : ndarray
+        Boolean array of length(x), True where the row of x is also in y
+
+    y_mask : ndarray
+        Boolean array of length(y), True where the row of y is also in x
+
+    y_to_x : ndarray
+        For each row of y, the index of the first matching row of x (-1 where
+        there is none)
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # adding 0. turns -0. into 0., so that the rows compare equal byte for byte
+    rows = np.ascontiguousarray(np.vstack([x, y]) + 0.)
+    rows = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, codes = np.unique(rows, return_inverse=True)
+    codes = codes.ravel()
+    x_codes, y_codes = codes[:x.shape[0]], codes[x.shape[0]:]
+
+    x_mask = np.isin(x_codes, y_codes)
+    if x.shape[0] == 0:
+        return x_mask, np.zeros(y.shape[0], dtype=bool), -np.ones(y.shape[0], dtype=np.int64)
+
+    # a stable sort, so each row of y maps to its first match in x
+    order = np.argsort(x_codes, kind='mergesort')
+    pos = np.minimum(np.searchsorted(x_codes[order], y_codes), x.shape[0] - 1)
+    y_mask = x_codes[order][pos] == y_codes
+    y_to_x = np.where(y_mask, order[pos], -1)
+    return x_mask, y_mask, y_to_x
 
 
 def make_gif_pngs(nifti, gif_path, index=range(100, 200), name=None, **kwargs):
@@ -942,85 +1862,128 @@ def make_gif_pngs(nifti, gif_path, index=range(100, 200), name=None, **kwargs):
     imageio.mimsave(gif_outfile, images)
 
 
-def _data_and_samplerate_by_file_index(bo, xform, **kwargs):
+def _resample(bo, resample_rate=64, anti_alias=False):
     """
-    Session dependent function application and aggregation
+    Function that resamples data to specified sample rate
+
+    Each session is resampled as a whole samples x electrodes block, into a
+    preallocated output.  The rate ratio is taken as a fraction up / down
+    (see _resample_factors), and both methods return the same samples, at
+    every down / up input samples from the session's first sample.  By
+    default, the block is interpolated at those times with a piecewise cubic
+    hermite interpolating polynomial.  If anti_alias is True, the block is
+    instead resampled with a polyphase filter (scipy.signal.resample_poly),
+    which low-pass filters the data so downsampling does not alias.
 
     Parameters
     ----------
     bo : Brain object
         Contains data
 
-    xform : function
-        The function to apply to the data matrix from each filename
+    resample_rate : int or float
+        Desired sample rate
 
-    aggregator: function
-        Function for aggregating results across multiple iterations
+    anti_alias : bool
+        If True, resample with an anti-aliasing polyphase filter.  Default
+        False.
 
     Returns
     ----------
-    results : numpy ndarray
-         Array of aggregated results
-
-    """
-    sample_rate = []
-
-    for idx, session in enumerate(bo.sessions.unique()):
-        if idx is 0:
-            data_results, session_results, sr_results = xform(bo.data.loc[bo.sessions == session],
-                                                                       bo.sessions.loc[bo.sessions == session],
-                                                                       bo.sample_rate[idx], **kwargs)
-            sample_rate.append(sr_results)
+    results: 2D np.ndarray
+        Resampled data - pd.DataFrame
+        Resampled sessions - pd.DataFrame
+        Resample rate - List of the actual rate of each session, which is
+        resample_rate unless the rate ratio had to be approximated
+
+    """
+    sessions = bo._session_codes
+    blocks = list(_session_chunks(sessions, chunk_size=max(len(sessions), 1), offsets=bo._session_offsets))
+    factors = [_resample_factors(bo.sample_rate[idx], resample_rate) for idx in range(len(blocks))]
+    lengths = [_resampled_length(_index_length(inds, len(sessions)), *factors[idx])
+               for idx, (session, inds) in enumerate(blocks)]
+
+    data = np.empty((sum(lengths), bo._values.shape[1]))
+    re_sessions = np.empty(sum(lengths), dtype=bo._session_ids.dtype)
+    rates = []
+    start = 0
+    values = bo._values
+    for idx, (session, inds) in enumerate(blocks):
+        stop = start + lengths[idx]
+        up, down = factors[idx]
+        data[start:stop] = _resample_block(values[inds], up, down, lengths[idx], anti_alias)
+        re_sessions[start:stop] = bo._session_ids[session]
+        if Fraction(resample_rate) == Fraction(bo.sample_rate[idx]) * Fraction(up, down):
+            rates.append(resample_rate)
         else:
-            data_next, session_next, sr_next = xform(bo.data.loc[bo.sessions == session, :],
-                                                                           bo.sessions.loc[bo.sessions == session],
-                                                                           bo.sample_rate[idx], **kwargs)
-            data_results = data_results.append(data_next, ignore_index=True)
-            session_results = session_results.append(session_next, ignore_index=True)
-            sample_rate.append(sr_next)
+            rates.append(bo.sample_rate[idx] * up / down)
+        start = stop
 
-    return data_results, session_results, sample_rate
+    return pd.DataFrame(data), pd.Series(re_sessions), rates
 
 
-
-def _resample(bo, resample_rate=64):
+def _index_length(inds, n):
     """
-    Function that resamples data to specified sample rate
+    Returns the number of samples selected by a slice or index array
+    """
+    if isinstance(inds, slice):
+        return len(range(*inds.indices(n)))
+    return len(inds)
 
-    Parameters
-    ----------
-    bo : Brain object
-        Contains data
 
-    Returns
-    ----------
-    results: 2D np.ndarray
-        Resampled data - pd.DataFrame
-        Resampled sessions - pd.DataFrame
-        Resample rate - List
+def _resampled_length(n_samples, up, down):
+    """
+    Returns the number of samples of a session of n_samples after resampling
+    by up / down (as scipy.signal.resample_poly)
+    """
+    return -(-n_samples * up // down)
 
+
+def _resample_factors(sample_rate, resample_rate):
+    """
+    Returns the up and down sampling factors of resample_rate / sample_rate,
+    exact if the ratio has a denominator of at most 1000, and the closest such
+    fraction otherwise
     """
+    ratio = (Fraction(resample_rate) / Fraction(sample_rate)).limit_denominator(1000)
+    return ratio.numerator, ratio.denominator
 
 
-    def _resamp(data, session, sample_rate, resample_rate):
+def _resample_block(data, up, down, n_out, anti_alias=False):
+    """
+    Resamples a samples x electrodes block by up / down
 
-        # number of samples for resample
-        n_samples = np.round(np.shape(data)[0] * resample_rate / sample_rate)
+    Parameters
+    ----------
+    data : np.ndarray
+        Samples x electrodes data of one session
 
-        # index for those samples
-        resample_index = np.round(np.linspace(data.index.min(), data.index.max(), n_samples))
+    up, down : int
+        Up and down sampling factors (see _resample_factors)
 
-        # resampled sessions
-        re_session = session[resample_index]
-        re_session.interpolate(method='pchip', inplace=True, limit_direction='both')
+    n_out : int
+        Number of samples to return (see _resampled_length)
 
-        # resampled data
-        re_data = data.loc[resample_index]
-        re_data.interpolate(method='pchip', inplace=True, limit_direction='both')
+    anti_alias : bool
+        If True, resample with scipy.signal.resample_poly.  Otherwise,
+        interpolate with scipy.interpolate.PchipInterpolator.
 
-        return re_data, re_session, resample_rate
+    Returns
+    ----------
+    results : np.ndarray
+        n_out x electrodes resampled data, at every down / up input samples
+        (up to the last input sample)
 
-    return _data_and_samplerate_by_file_index(bo, _resamp, resample_rate=resample_rate)
+    """
+    if n_out == 0:
+        return np.empty((0, data.shape[1]))
+    if anti_alias:
+        return signal.resample_poly(data, up, down, axis=0)[:n_out]
+    if data.shape[0] < 2:
+        return np.repeat(np.atleast_2d(data), n_out, axis=0)
+    x = np.arange(data.shape[0])
+    # the last sample time can pass the last input sample (e.g. up / down = 3 / 2), so
+    # it is clamped rather than extrapolated
+    return PchipInterpolator(x, data, axis=0)(np.minimum(np.arange(n_out) * down / up, x[-1]))
 
 
 def _plot_locs_connectome(locs, label=None, pdfpath=None):
@@ -1126,25 +2089,103 @@ def _nifti_to_brain(nifti, mask_file=None):
     else:
         warnings.warn('Nifti format not supported')
 
-    mask = NiftiMasker(mask_strategy='background')
+    hdr = img.header
+    mask, R = _nifti_mask_locs(img, mask_file)
+
+    # index the image data directly rather than copying it through the masker
+    data = np.asanyarray(img.dataobj)
+    if data.ndim == 3:
+        Y = data[mask][np.newaxis, :]
+    else:
+        Y = data[mask].T
+    Y = np.asarray(Y, dtype=np.float64)
+
+    return Y, R, {'header': hdr}
+
+
+def _nifti_key(img):
+    """
+    Returns a key identifying a nifti image, used to key cached masks: its file
+    and modification time if it was loaded from one, and otherwise a digest of
+    its shape, affine and data, hashed a volume at a time
+    """
+    fname = img.get_filename()
+    if fname is not None and os.path.exists(fname):
+        return fname, os.path.getmtime(fname)
+    shape = tuple(img.shape)
+    digest = hashlib.md5()
+    digest.update(np.asarray(img.affine, dtype=np.float64).tobytes())
+    digest.update(str(shape).encode())
+    for index in np.ndindex(*shape[3:]):
+        volume = np.ascontiguousarray(img.dataobj[(slice(None),) * 3 + index])
+        digest.update(volume.view(np.uint8).ravel())
+    return digest.hexdigest()
+
+
+_MASK_CACHE_SIZE = 8
+_mask_cache = OrderedDict()
+
+
+def _nifti_mask_locs(img, mask_file=None):
+    """
+    Fits a background mask to a nifti image and finds the locations of the
+    masked voxels
+
+    The voxel coordinates are taken from np.nonzero of the mask and mapped
+    through the image's affine.  Results are cached per template (keyed on
+    the image and mask files, see _nifti_key), so repeated models or brain
+    objects built from the same template skip the masking.
+
+    Parameters
+    ----------
+    img : nifti image
+        Image to mask
+
+    mask_file : str, nifti image or None
+        If given, the mask is fit to this image instead
+
+    Returns
+    ----------
+    mask : ndarray
+        3D boolean mask
+
+    locs : ndarray
+        Locations of the masked voxels (in the order of np.nonzero(mask)); a
+        copy, so callers may modify it
+
+    """
     if mask_file is None:
-        mask.fit(nifti)
+        mask_key = None
+    elif isinstance(mask_file, six.string_types):
+        mask_key = (mask_file, os.path.getmtime(mask_file))
     else:
-        mask.fit(mask_file)
+        mask_key = _nifti_key(mask_file)
+    key = (_nifti_key(img), mask_key)
 
-    hdr = img.header
-    S = img.get_sform()
+    if key in _mask_cache:
+        _mask_cache[key] = _mask_cache.pop(key)
+        mask, R = _mask_cache[key]
+        return mask, R.copy()
 
-    Y = np.float64(mask.transform(nifti)).copy()
-    vmask = np.nonzero(np.array(np.reshape(mask.mask_img_.dataobj, (1, np.prod(mask.mask_img_.shape)), order='C')))[1]
-    vox_coords = _fullfact(img.shape[0:3])[vmask, ::-1] - 1
+    masker = NiftiMasker(mask_strategy='background')
+    if mask_file is None:
+        masker.fit(img)
+    else:
+        masker.fit(mask_file)
 
-    R = np.array(np.dot(vox_coords, S[0:3, 0:3])) + S[:3, 3]
+    mask = np.asanyarray(masker.mask_img_.dataobj).astype(bool)
+    vox_coords = np.array(np.nonzero(mask)).T
+    S = img.get_sform()
+    R = np.dot(vox_coords, S[0:3, 0:3]) + S[:3, 3]
 
-    return Y, R, {'header': hdr}
+    mask.setflags(write=False)
+    _mask_cache[key] = (mask, R)
+    if len(_mask_cache) > _MASK_CACHE_SIZE:
+        _mask_cache.popitem(last=False)
+    return mask, R.copy()
 
 
-def _brain_to_nifti(bo, nii_template): #FIXME: this is incredibly inefficient; could be done much faster using reshape and/or nilearn masking
+def _brain_to_nifti(bo, nii_template, filepath=None, chunk_size=1000):
 
     """
     Takes or loads nifti file and converts to brain object
@@ -1157,6 +2198,16 @@ def _brain_to_nifti(bo, nii_template): #FIXME: this is incredibly inefficient; c
 
         Template is a nifti file with the desired resolution to save the brain object activity
 
+    filepath : str or None
+
+        Path to save the nifti file.  If uncompressed (.nii), the image is
+        written straight into a memory map of the file, chunk_size samples at a
+        time, rather than built in memory
+
+    chunk_size : int
+
+        Number of samples scattered into the volume at a time
+
 
     Returns
     ----------
@@ -1167,25 +2218,57 @@ def _brain_to_nifti(bo, nii_template): #FIXME: this is incredibly inefficient; c
     """
     from .nifti import Nifti
 
-    hdr = nii_template.get_header()
-    temp_v_size = hdr.get_zooms()[0:3]
-
     R = bo.get_locs()
-    Y = bo.data.as_matrix()
-    Y = np.array(Y, ndmin=2)
+    Y = np.atleast_2d(np.asarray(bo.get_data()))
     S = nii_template.affine
     locs = np.array(np.dot(R - S[:3, 3], np.linalg.inv(S[0:3, 0:3])), dtype='int')
 
-    shape = np.max(np.vstack([np.max(locs, axis=0) + 1, nii_template.shape[0:3]]), axis=0)
-    data = np.zeros(tuple(list(shape) + [Y.shape[0]]))
-    counts = np.zeros(data.shape)
+    shape = tuple(np.max(np.vstack([np.max(locs, axis=0) + 1, nii_template.shape[0:3]]), axis=0))
+
+    # electrodes falling in the same voxel are averaged, using a 3D count
+    # volume rather than one count per sample
+    voxels, inverse, counts = np.unique(np.ravel_multi_index(locs.T, shape, order='F'), return_inverse=True,
+                                        return_counts=True)
+    inverse = inverse.ravel()
+    if len(voxels) == R.shape[0]:
+        averager = None
+        voxels = voxels[inverse]
+    else:
+        averager = sparse.csr_matrix((1. / counts[inverse], (inverse, np.arange(R.shape[0]))),
+                                     shape=(len(voxels), R.shape[0]))
+
+    if filepath is not None and not os.path.splitext(filepath)[1]:
+        filepath += '.nii'
+
+    if filepath is not None and filepath.endswith('.nii'):
+        hdr = nib.Nifti1Header()
+        hdr.set_data_shape(shape + (Y.shape[0],))
+        hdr.set_data_dtype(np.float64)
+        hdr.set_qform(S, code=1)
+        hdr.set_sform(S, code=1)
+        hdr.set_data_offset(352)
+        with open(filepath, 'wb') as f:
+            hdr.write_to(f)
+            f.write(b'\x00' * (352 - f.tell()))
+        data = np.memmap(filepath, dtype=np.float64, mode='r+', offset=352, shape=shape + (Y.shape[0],),
+                         order='F')
+    else:
+        data = np.zeros(shape + (Y.shape[0],), order='F')
 
-    for i in range(R.shape[0]):
-        data[locs[i, 0], locs[i, 1], locs[i, 2], :] += Y[:, i]
-        counts[locs[i, 0], locs[i, 1], locs[i, 2], :] += 1
+    flat = data.reshape(-1, Y.shape[0], order='F')
+    for start in range(0, Y.shape[0], chunk_size):
+        block = Y[start:start + chunk_size]
+        if averager is None:
+            flat[voxels, start:start + chunk_size] = block.T
+        else:
+            flat[voxels, start:start + chunk_size] = averager.dot(block.T)
 
-    with np.errstate(invalid='ignore'):
-        for i in range(R.shape[0]):
-            data[locs[i, 0], locs[i, 1], locs[i, 2], :] = np.divide(data[locs[i, 0], locs[i, 1], locs[i, 2], :], counts[locs[i, 0], locs[i, 1], locs[i, 2], :])
+    if isinstance(data, np.memmap):
+        data.flush()
+        del flat, data
+        return Nifti(filepath)
 
-    return Nifti(data, affine=nii_template.affine)
+    nifti = Nifti(data, affine=nii_template.affine)
+    if filepath is not None:
+        nifti.to_filename(filepath)
+    return nifti
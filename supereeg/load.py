@@ -4,9 +4,11 @@ import warnings
 import requests
 import numpy as np
 import deepdish as dd
+import tables
 from .brain import Brain
 from .model import Model
 from .nifti import Nifti
+from .plan import PredictionPlan
 from .helpers import tal2mni, _gray, _std, _resample_nii
 
 BASE_URL = 'https://docs.google.com/uc?export=download'
@@ -23,12 +25,12 @@ datadict = { #TODO: do the data types need to be specified or could they be infe
 }
 
 def load(fname, vox_size=None, return_type=None, sample_inds=None,
-         loc_inds=None, field=None):
+         loc_inds=None, field=None, mmap_mode=None, mmap_cache=None):
     """
     Load nifti file, brain or model object, or example data.
 
-    This function can load in example data, as well as nifti objects (.nii), brain objects (.bo)
-    and model objects (.mo) by detecting the extension and calling the appropriate
+    This function can load in example data, as well as nifti objects (.nii), brain objects (.bo),
+    model objects (.mo) and prediction plans (.pp) by detecting the extension and calling the appropriate
     load function.  Thus, be sure to include the file extension in the fname
     parameter.
 
@@ -88,9 +90,24 @@ def load(fname, vox_size=None, return_type=None, sample_inds=None,
         The particular field of the data you want to load. This will work for
         Brain objects and Model objects.
 
+    mmap_mode : None, 'r', 'r+' or 'c'
+        If not None, the data of a Brain object are memory mapped (see
+        numpy.memmap) rather than read in, so only the samples that are used
+        are read from disk.  This requires the .bo file to have been saved
+        with compression=None (and h5py), so the data are mapped straight
+        from the file.  Compressed data cannot be mapped: unless mmap_cache
+        is given, a warning is issued and the data are read in.
+
+    mmap_cache : str or None
+        Path of a .npy file to memory map compressed data from.  If given and
+        the data are compressed, they are decompressed to this file (in
+        chunks, so they are never all in memory), which is reused while it is
+        newer than the .bo file.  Note that the file is as large as the
+        uncompressed data.  Default None (no file is written).
+
     Returns
     ----------
-    data : supereeg.Nifti, supereeg.Brain or supereeg.Model
+    data : supereeg.Nifti, supereeg.Brain, supereeg.Model or supereeg.PredictionPlan
         Data to be returned
 
     """
@@ -98,9 +115,9 @@ def load(fname, vox_size=None, return_type=None, sample_inds=None,
         raise ValueError("Using both field and slicing currently not supported.")
 
     if fname in datadict.keys():
-        data = _load_example(fname, datadict[fname], sample_inds, loc_inds, field)
+        data = _load_example(fname, datadict[fname], sample_inds, loc_inds, field, mmap_mode, mmap_cache)
     else:
-        data = _load_from_path(fname, sample_inds, loc_inds, field)
+        data = _load_from_path(fname, sample_inds, loc_inds, field, mmap_mode, mmap_cache)
     if field is None:
         return _convert(data, return_type, vox_size)
     else:
@@ -133,7 +150,7 @@ def _convert(data, return_type, vox_size):
             data = Model(data)
         return data
 
-def _load_example(fname, fileid, sample_inds, loc_inds, field):
+def _load_example(fname, fileid, sample_inds, loc_inds, field, mmap_mode=None, mmap_cache=None):
     """ Loads in dataset given a google file id """
     fullpath = os.path.join(homedir, 'supereeg_data', fname + '.' + fileid[1])
     if not os.path.exists(datadir):
@@ -141,17 +158,20 @@ def _load_example(fname, fileid, sample_inds, loc_inds, field):
     if not os.path.exists(fullpath):
         try:
             _download(fname, _load_stream(fileid[0]), fileid[1])
-            data = _load_from_cache(fname, fileid[1], sample_inds, loc_inds, field)
+            data = _load_from_cache(fname, fileid[1], sample_inds, loc_inds, field, mmap_mode,
+                                    mmap_cache)
         except ValueError as e:
             print(e)
             raise ValueError('Download failed.')
     else:
         try:
-            data = _load_from_cache(fname, fileid[1], sample_inds, loc_inds, field)
+            data = _load_from_cache(fname, fileid[1], sample_inds, loc_inds, field, mmap_mode,
+                                    mmap_cache)
         except:
             try:
                 _download(fname, _load_stream(fileid[0]), fileid[1])
-                data = _load_from_cache(fname, fileid[1], sample_inds, loc_inds, field)
+                data = _load_from_cache(fname, fileid[1], sample_inds, loc_inds, field, mmap_mode,
+                                        mmap_cache)
             except ValueError as e:
                 print(e)
                 raise ValueError('Download failed. Try deleting cache data in'
@@ -180,7 +200,7 @@ def _download(fname, data, ext):
     with open(fullpath + '.' + ext, 'wb') as f:
         f.write(data.content)
 
-def _load_from_path(fpath, sample_inds=None, loc_inds=None, field=None):
+def _load_from_path(fpath, sample_inds=None, loc_inds=None, field=None, mmap_mode=None, mmap_cache=None):
     """ Load a file from a local path """
     try:
         ext = fpath.split('.')[-1]
@@ -194,16 +214,21 @@ def _load_from_path(fpath, sample_inds=None, loc_inds=None, field=None):
     elif ext=='bo':
         if sample_inds!=None or loc_inds!=None:
             return Brain(**_load_slice(fpath, sample_inds, loc_inds))
+        elif mmap_mode is not None:
+            return Brain(**_load_mmap(fpath, mmap_mode, mmap_cache))
         else:
             return Brain(**dd.io.load(fpath))
     elif ext=='mo':
         return Model(**dd.io.load(fpath))
+    elif ext=='pp':
+        return PredictionPlan(**dd.io.load(fpath))
     elif ext in ('nii', 'gz'):
         return Nifti(fpath)
     else:
-        raise ValueError("Filetype not recognized. Must be .bo, .mo or .nii.")
+        raise ValueError("Filetype not recognized. Must be .bo, .mo, .pp or .nii.")
 
-def _load_from_cache(fname, ftype, sample_inds=None, loc_inds=None, field=None):
+def _load_from_cache(fname, ftype, sample_inds=None, loc_inds=None, field=None, mmap_mode=None,
+                     mmap_cache=None):
     """ Load a file from local data cache """
     fullpath = os.path.join(homedir, 'supereeg_data', fname + '.' + ftype)
     if field != None:
@@ -214,6 +239,8 @@ def _load_from_cache(fname, ftype, sample_inds=None, loc_inds=None, field=None):
     elif ftype is 'bo':
         if sample_inds!=None or loc_inds!=None:
             return Brain(**_load_slice(fullpath, sample_inds, loc_inds))
+        elif mmap_mode is not None:
+            return Brain(**_load_mmap(fullpath, mmap_mode, mmap_cache))
         else:
             return Brain(**dd.io.load(fullpath))
     elif ftype is 'mo':
@@ -273,3 +300,95 @@ def _load_slice(fname, sample_inds=None, loc_inds=None):
             data = data.T
     return dict(data=data, locs=locs,
                 sample_rate=sample_rate, meta=meta, date_created=date_created)
+
+def _load_mmap(fname, mmap_mode='r', cache_path=None):
+    """
+    Load a brain object with memory mapped data
+
+    Parameters
+    ----------
+    fname : str
+        Path to brain object
+
+    mmap_mode : 'r', 'r+' or 'c'
+        Memory map mode (see numpy.memmap)
+
+    cache_path : str or None
+        Path of the .npy file to decompress compressed data to (see _mmap_data)
+
+    Returns
+    ----------
+    data : dict
+        Dictionary of contents to pass to brain object
+
+    """
+    if mmap_mode not in ('r', 'r+', 'c'):
+        raise ValueError("Please set mmap_mode to 'r', 'r+' or 'c'.")
+
+    with tables.open_file(fname, mode='r') as f:
+        stored = set(node._v_name for node in f.root) | set(f.root._v_attrs._f_list('user'))
+    fields = ['locs', 'sessions', 'sample_rate', 'kurtosis', 'kurtosis_threshold',
+              'meta', 'date_created', 'minimum_voxel_size',
+              'maximum_voxel_size', 'label', 'filter']
+    bo = {field: dd.io.load(fname, group='/' + field) for field in fields if field in stored} #FIXME: use os.path.join rather than using slashes
+    bo['data'] = _mmap_data(fname, mmap_mode, cache_path)
+    if bo['data'] is None:
+        warnings.warn('The data of ' + fname + ' are compressed and cannot be memory mapped, so they '
+                      'are read in.  Save with compression=None, or pass mmap_cache, to map them.')
+        bo['data'] = dd.io.load(fname, group='/data') #FIXME: use os.path.join rather than using slashes
+    return bo
+
+def _mmap_data(fname, mmap_mode='r', cache_path=None, chunk_size=10000):
+    """
+    Memory maps the data of a brain object file
+
+    If the data are stored uncompressed and contiguous, they are mapped
+    directly from the .bo file.  Otherwise, if cache_path is given, they are
+    copied chunk by chunk to that .npy file (reused while it is newer than the
+    .bo file), and that file is mapped.
+
+    Parameters
+    ----------
+    fname : str
+        Path to brain object
+
+    mmap_mode : 'r', 'r+' or 'c'
+        Memory map mode (see numpy.memmap)
+
+    cache_path : str or None
+        Path of the .npy file to copy data that cannot be mapped directly to
+
+    chunk_size : int
+        Number of samples copied at a time
+
+    Returns
+    ----------
+    data : numpy.memmap or None
+        Samples x electrodes memory mapped data, or None if the data cannot be
+        mapped directly and cache_path is None
+
+    """
+    try:
+        import h5py
+        with h5py.File(fname, 'r') as f:
+            dset = f['data']
+            offset = dset.id.get_offset()
+            if dset.chunks is None and offset is not None:
+                return np.memmap(fname, dtype=dset.dtype, mode=mmap_mode, offset=offset, shape=dset.shape)
+    except ImportError:
+        pass
+
+    if cache_path is None:
+        return None
+
+    npy_path = cache_path
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(fname):
+        with tables.open_file(fname, mode='r') as f:
+            node = f.get_node('/data')
+            data = np.lib.format.open_memmap(npy_path, mode='w+', dtype=node.dtype,
+                                             shape=tuple(int(n) for n in node.shape))
+            for start in range(0, node.shape[0], chunk_size):
+                data[start:start + chunk_size] = node[start:start + chunk_size]
+            data.flush()
+            del data
+    return np.load(npy_path, mmap_mode=mmap_mode)
@@ -2,18 +2,25 @@ from __future__ import division
 from __future__ import print_function
 import time
 import copy
+import hashlib
 import warnings
+import multiprocessing
 import six
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 import seaborn as sns
 import deepdish as dd
 import matplotlib.pyplot as plt
 from .helpers import _get_corrmat, _r2z, _z2r, _rbf, _expand_corrmat_fit, _expand_corrmat_predict,\
-    _near_neighbor, _timeseries_recon, _count_overlapping, _plot_locs_connectome, _plot_locs_hyp, _gray, _nifti_to_brain
+    _near_neighbor, _timeseries_recon, _recon_projection, _timeseries_recon_stream, _kurt_stats, \
+    _merge_kurt_stats, _kurt_from_stats, _overlap_index, _pack_triu, _unpack_triu, _low_rank_factors, _nystrom_factors, \
+    _low_rank_projection, _read_only, _plot_locs_connectome, _plot_locs_hyp, _gray, _nifti_to_brain
 from .brain import Brain
-from scipy.spatial.distance import cdist
+from joblib import Parallel, delayed
 
+# number of reconstruction operators (one per subject montage) cached per model
+_PROJECTION_CACHE_SIZE = 16
 
 class Model(object):
     """
@@ -62,6 +69,46 @@ class Model(object):
     date created : str
         Time created
 
+    rbf_cutoff : int, float or None
+        If given, RBF weights between locations further apart than rbf_cutoff
+        (in mm) are treated as zero, and the expansion is computed with sparse
+        weights.  Default None (dense weights).
+
+    store_subjects : bool
+        If True, the model keeps each brain object's compact contribution (its
+        zscored correlation matrix and electrode locations) in `subjects`, so
+        it can later be mapped onto other locations exactly rather than from
+        the averaged model.  Default False.
+
+    subjects : list of dict or None
+        (Optional) Stored subject contributions, as saved with the model.  Each
+        dict holds the subject's zscored correlation matrix ('corrmat') and
+        electrode locations ('locs').
+
+    n_jobs : int
+        Number of processes used to compute the subjects' contributions
+        (default 1).  -1 uses all cpus.  Data given as file paths are loaded
+        in the workers, and contributions are added to the model n_jobs at a
+        time, so no more than n_jobs of them are held in memory at once.
+
+    dtype : numpy dtype or None
+        Precision in which the numerator and denominator are stored (e.g.
+        np.float32 to halve their memory).  If None, the dtype of the numerator
+        passed in is used, or float64.
+
+    packed : bool
+        If True, only the upper triangles of the (symmetric) numerator and
+        denominator are stored, halving their memory again.  Accessing
+        numerator or denominator returns a full, read-only matrix unpacked
+        from them, so to change a packed model, assign a new matrix (e.g.
+        model.numerator = model.numerator * 2).  Packed models are saved
+        packed, and a 1D numerator passed in is taken to be packed.  Default
+        False.
+
+    factors : dict or None
+        (Optional) Low-rank factors of the model, as saved with it (see
+        Model.set_low_rank).
+
 
     Attributes
     ----------
@@ -76,6 +123,13 @@ class Model(object):
     n_subs : int
         Number of subject used to create the model
 
+    subjects : list of dict or None
+        Stored subject contributions (None unless store_subjects is True)
+
+    factors : dict or None
+        Low-rank factors ('vecs', 'vals') of the model correlation matrix, used
+        by predict when set (see Model.set_low_rank)
+
 
     Returns
     ----------
@@ -86,7 +140,24 @@ class Model(object):
     #TODO: __init__ should support data as a brain object, model object, nifti object, or string; if model object, just return data without copying it
     def __init__(self, data=None, locs=None, template=None,
                  measure='kurtosis', threshold=10, numerator=None, denominator=None,
-                 n_subs=None, meta=None, date_created=None):
+                 n_subs=None, meta=None, date_created=None, rbf_cutoff=None,
+                 store_subjects=False, subjects=None, n_jobs=1, dtype=None, packed=False,
+                 factors=None):
+
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+        elif numerator is not None:
+            self.dtype = np.asarray(numerator).dtype
+        else:
+            self.dtype = np.dtype(np.float64)
+        self.packed = packed or (numerator is not None and np.ndim(numerator) == 1)
+
+        if subjects is not None:
+            self.subjects = list(subjects)
+        elif store_subjects:
+            self.subjects = []
+        else:
+            self.subjects = None
 
         if all(v is not None for v in [numerator, denominator, locs, n_subs]):
             _handle_superuser(self, numerator, denominator, locs, n_subs)
@@ -94,22 +165,24 @@ class Model(object):
             _create_locs(self, locs, template)
 
             s = self.locs.shape[0]
-            self.numerator = np.zeros((s, s))
-            self.denominator = np.zeros((s, s))
+            shape = (s * (s + 1) // 2,) if self.packed else (s, s)
+            numerator = np.zeros(shape, dtype=self.dtype)
+            denominator = np.zeros(shape, dtype=self.dtype)
             self.n_subs = 0
 
             if type(data) is not list:
                 data = [data]
 
-            for d in data:
-                d = _format_data(d, self.locs)
-                if isinstance(d, Brain):
-                    num_corrmat_x, denom_corrmat_x, n_subs = _bo2model(d, self.locs, measure, threshold)
-                elif isinstance(d, Model):
-                    num_corrmat_x, denom_corrmat_x, n_subs = _mo2model(d, self.locs)
-                self.numerator += num_corrmat_x
-                self.denominator += denom_corrmat_x
+            for num_corrmat_x, denom_corrmat_x, n_subs, subjects in _contributions(data, self.locs,
+                                                                                   rbf_cutoff=rbf_cutoff,
+                                                                                   n_jobs=n_jobs):
+                numerator += _store_matrix(num_corrmat_x, self.dtype, self.packed)
+                denominator += _store_matrix(denom_corrmat_x, self.dtype, self.packed)
                 self.n_subs += n_subs
+                if self.subjects is not None and subjects is not None:
+                    self.subjects.extend(subjects)
+            self.numerator = numerator
+            self.denominator = denominator
 
         if not date_created:
             self.date_created = time.strftime("%c")
@@ -117,14 +190,97 @@ class Model(object):
             self.date_created = date_created
         self.n_locs = self.locs.shape[0]
         self.meta = meta
+        self.factors = factors
+        self._proj_cache = OrderedDict()
+
+    @property
+    def numerator(self):
+        """Sum of the zscored correlation matrices over subjects (read-only if packed)"""
+        if self.packed:
+            return _read_only(_unpack_triu(self._numerator))
+        return self._numerator
+
+    @numerator.setter
+    def numerator(self, value):
+        self._numerator = _store_matrix(value, self.dtype, self.packed)
+        self._proj_cache = OrderedDict()
+
+    @property
+    def denominator(self):
+        """Sum of the number of subjects contributing to each matrix cell (read-only if packed)"""
+        if self.packed:
+            return _read_only(_unpack_triu(self._denominator))
+        return self._denominator
+
+    @denominator.setter
+    def denominator(self, value):
+        self._denominator = _store_matrix(value, self.dtype, self.packed)
+        self._proj_cache = OrderedDict()
 
     def get_model(self):
         """ Returns a copy the model in the form of a correlation matrix"""
         with np.errstate(invalid='ignore'):
             return _z2r(np.divide(self.numerator, self.denominator))
 
+    def set_low_rank(self, rank=100, method='randomized', n_landmarks=None, random_state=None):
+        """
+        Computes a low-rank approximation of the model, which predict then uses
+
+        The model correlation matrix (with a zeroed diagonal, as used by
+        predict) is approximated as vecs . diag(vals) . vecs.T.  predict then
+        builds the reconstruction operator from the factors, in memory that
+        grows with the number of locations times the rank rather than with
+        the square of the number of locations.  Brain object locations that
+        are not model locations take the rbf-weighted average of the model's
+        factor rows, which approximates (but is not) the rbf expansion the
+        full model uses for them.  With method='eig' and rank equal to the
+        number of locations, predictions match those of the full model when
+        all of the brain object's electrodes are at model locations; otherwise
+        only the observed electrodes match.
+
+        Parameters
+        ----------
+        rank : int
+            Number of factors kept (default 100)
+
+        method : 'eig', 'randomized' or 'nystrom'
+            'eig' uses a full eigendecomposition, 'randomized' a randomized
+            one (default), and 'nystrom' only the model's columns at
+            n_landmarks randomly chosen locations.
+
+        n_landmarks : int or None
+            Number of landmark locations for 'nystrom' (default 2 * rank)
+
+        random_state : int, RandomState or None
+            Seed for the 'randomized' and 'nystrom' methods
+
+        The factors are saved with the model, and are discarded when the model
+        is updated.
+
+        """
+        if method == 'nystrom':
+            n = self.locs.shape[0]
+            if isinstance(random_state, np.random.RandomState):
+                rng = random_state
+            else:
+                rng = np.random.RandomState(random_state)
+            landmarks = np.sort(rng.choice(n, min(n, n_landmarks or 2 * rank), replace=False))
+            with np.errstate(invalid='ignore'):
+                cols = _z2r(np.divide(self.numerator[:, landmarks], self.denominator[:, landmarks]))
+            cols[np.isnan(cols)] = 0
+            cols[landmarks, np.arange(len(landmarks))] = 0
+            vecs, vals = _nystrom_factors(cols, landmarks, rank)
+        else:
+            corrmat = self.get_model()
+            corrmat[np.isnan(corrmat)] = 0
+            np.fill_diagonal(corrmat, 0)
+            vecs, vals = _low_rank_factors(corrmat, rank, method=method, random_state=random_state)
+        self.factors = {'vecs': vecs, 'vals': vals}
+        self._proj_cache.clear()
+
     def predict(self, bo, nearest_neighbor=True, match_threshold='auto',
-                force_update=False, kthreshold=10, preprocess='zscore'):
+                force_update=False, kthreshold=10, preprocess='zscore', n_jobs=1,
+                tile_size=256, rbf_cutoff=None, reg=0):
         """
         Takes a brain object and a 'full' covariance model, fills in all
         electrode timeseries for all missing locations and returns the new brain
@@ -158,6 +314,29 @@ class Model(object):
             The predict algorithm requires the data to be zscored.  However, if
             your data are already zscored you can bypass this by setting to None.
 
+        n_jobs : int
+            Number of parallel jobs used to expand the model to the subject's
+            locations (default 1).  -1 uses all cpus.
+
+        tile_size : int
+            Number of subject locations expanded per block (default 256).
+
+        rbf_cutoff : int, float or None
+            If given, RBF weights between locations further apart than
+            rbf_cutoff (in mm) are treated as zero, and the expansion is
+            computed with sparse weights.  Default None (dense weights).
+
+        reg : int or float
+            Regularization added to the diagonal of the observed locations'
+            correlation matrix before it is inverted (default 0).
+
+        The reconstruction operator for a given set of observed locations is
+        cached on the model, so repeated calls with the same montage skip the
+        matrix inversion.  The cache is cleared when the model is updated.
+
+        If the model has low-rank factors (see set_low_rank), they are used
+        instead of the full model, unless force_update is True.
+
         Returns
         ----------
         bo_p : supereeg.Brain
@@ -167,54 +346,158 @@ class Model(object):
         if preprocess not in ('zscore', None,):
             raise ValueError('Please set preprocess to either zscore or None.')
 
-        bo = bo.get_filtered_bo() #TODO: IMPLEMENT THIS in Brain.py -- should return a copy of the brain object with only the electrodes that pass the filtering, and with filter=None
+        if self.factors is not None and not force_update:
+            bo, proj, loc_label, perm_locs = _low_rank_plan(self, bo, nearest_neighbor, match_threshold,
+                                                            rbf_cutoff, reg)
+            model_corrmat_x = None
+            observed_only = proj is None
+        else:
+            bo, model_corrmat_x, loc_label, perm_locs = _predict_plan(self, bo, nearest_neighbor, match_threshold,
+                                                                      force_update, n_jobs, tile_size, rbf_cutoff)
+            observed_only = model_corrmat_x is None
+            if observed_only or force_update:
+                proj = None
+            else:
+                proj = _cached_projection(self, model_corrmat_x, bo.get_locs(), rbf_cutoff=rbf_cutoff, reg=reg)
+
+        if observed_only:
+            return Brain(data=bo.data, locs=bo.locs, sessions=bo.sessions,
+                         sample_rate=bo.sample_rate, label=bo.label)
 
-        # if match_threshold auto, ignore all electrodes whose distance from the
-        # nearest matching voxel is greater than the maximum voxel dimension
-        if nearest_neighbor:
-            bo = _near_neighbor(bo, self, match_threshold=match_threshold)
+        activations = _timeseries_recon(bo, model_corrmat_x, preprocess=preprocess, proj=proj, reg=reg)
 
-        if self.locs.shape[0] > 1000:
-            warnings.warn('Model locations exceed 1000, this may take a while. Good time for a cup of coffee.')
+        return Brain(data=activations, locs=perm_locs, sessions=bo.sessions,
+                    sample_rate=bo.sample_rate, kurtosis=None, label=loc_label)
 
-        # if True will update the model with subject's correlation matrix
-        if force_update:
-            model_corrmat_x = _force_update(self, bo)
-        else:
-            with np.errstate(invalid='ignore'):
-                model_corrmat_x = np.divide(self.numerator, self.denominator)
-
-        bool_mask = _count_overlapping(self, bo)
-        case = _which_case(bo, bool_mask)
-        if case is 'all_overlap':
-            d = cdist(bo.get_locs(), self.locs)
-            joint_bo_inds = np.where(np.isclose(d, 0))[0]
-            bo.locs = bo.locs.iloc[joint_bo_inds]
-            bo.data = bo.data[joint_bo_inds]
-            bo.kurtosis = bo.kurtosis[joint_bo_inds]
-            bo.label = np.array(bo.label)[joint_bo_inds].tolist()
+    def predict_stream(self, data, out=None, chunk_size=1000, nearest_neighbor=True,
+                       match_threshold='auto', preprocess='zscore', n_jobs=1,
+                       tile_size=256, rbf_cutoff=None, reg=0):
+        """
+        Reconstructs a recording chunk by chunk, without loading it into memory
 
-            return Brain(data=bo.data, locs=bo.locs, sessions=bo.sessions,
-                         sample_rate=bo.sample_rate, label=bo.label)
+        The model is expanded to the recording's locations once, using only the
+        locations saved in the file.  The data are then read in chunks of
+        chunk_size samples: a first pass collects per-session means and
+        covariances, and a second pass z-scores, reconstructs and returns (or
+        writes) each chunk.  The result matches Model.predict.
+
+        Parameters
+        ----------
+        data : str or supereeg.Brain
+            Path to a .bo file, or a brain object
+
+        out : str or None
+            If None (default), returns a generator of reconstructed chunks.  If a
+            filepath, the chunks are written to a .npy file at that path, and a
+            brain object backed by a read-only memory map of it is returned.
+
+        chunk_size : int
+            Number of samples read and reconstructed at a time (default 1000)
+
+        nearest_neighbor, match_threshold, preprocess, n_jobs, tile_size, rbf_cutoff, reg :
+            See Model.predict
+
+        Returns
+        ----------
+        results : generator or supereeg.Brain
+            If out is None, a generator of (start sample, samples x locations
+            array) tuples, with the reconstructed locations followed by the
+            observed locations.  Otherwise, a brain object containing the
+            reconstruction.
+
+        """
+        from .load import load
+
+        if preprocess not in ('zscore', None,):
+            raise ValueError('Please set preprocess to either zscore or None.')
+
+        if isinstance(data, six.string_types):
+            fields = {f: load(data, field=f) for f in ['locs', 'kurtosis', 'kurtosis_threshold',
+                                                        'filter', 'sessions', 'sample_rate']}
+
+            def read(start, stop):
+                return dd.io.load(data, group='/data', sel=dd.aslice[start:stop, :])
         else:
-            # indices of the mask (where there is overlap
-            joint_model_inds = np.where(bool_mask)[0]
-            if case is 'no_overlap':
-                model_corrmat_x, loc_label, perm_locs = _no_overlap(self, bo, model_corrmat_x)
-            elif case is 'some_overlap':
-                model_corrmat_x, loc_label, perm_locs = _some_overlap(self, bo, model_corrmat_x, joint_model_inds)
-            elif case is 'subset':
-                model_corrmat_x, loc_label, perm_locs = _subset(self, bo, model_corrmat_x, joint_model_inds)
-
-            model_corrmat_x = _z2r(model_corrmat_x)
-            np.fill_diagonal(model_corrmat_x, 0)
-            activations = _timeseries_recon(bo, model_corrmat_x, preprocess=preprocess)
-
-            return Brain(data=activations, locs=perm_locs, sessions=bo.sessions,
-                        sample_rate=bo.sample_rate, kurtosis=None, label=loc_label)
+            fields = {f: getattr(data, f) for f in ['locs', 'kurtosis', 'kurtosis_threshold',
+                                                     'filter', 'sessions', 'sample_rate']}
+            values = data._values
+
+            def read(start, stop):
+                return values[start:stop]
+
+        bo, obs_inds, proj, loc_label, perm_locs = _montage_plan(self, fields, nearest_neighbor, match_threshold,
+                                                                 n_jobs, tile_size, rbf_cutoff, reg)
+        if proj is None:
+            # as in Model.predict, observed locations are returned unchanged
+            proj = np.zeros((0, len(obs_inds)))
+            preprocess = None
+
+        sessions = np.asarray(fields['sessions']).ravel()
+        chunks = _timeseries_recon_stream(lambda start, stop: read(start, stop)[:, obs_inds], sessions, proj,
+                                          chunk_size=chunk_size, preprocess=preprocess)
+        if out is None:
+            return chunks
+
+        if out[-4:] != '.npy':
+            out += '.npy'
+        recon = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64,
+                                          shape=(len(sessions), len(perm_locs)))
+        stats = {}
+        for start, chunk in chunks:
+            recon[start:start + chunk.shape[0]] = chunk
+            chunk_sessions = sessions[start:start + chunk.shape[0]]
+            for s in np.unique(chunk_sessions):
+                stats[s] = _merge_kurt_stats(stats.get(s), _kurt_stats(chunk[chunk_sessions == s]))
+        recon.flush()
+        del recon
+
+        kurt = np.max(np.vstack([_kurt_from_stats(stats[s]) for s in pd.unique(sessions)]), axis=0)
+        return Brain(data=np.load(out, mmap_mode='r'), locs=perm_locs, sessions=sessions,
+                     sample_rate=fields['sample_rate'], kurtosis=kurt, label=loc_label, filter=None)
+
+    def predict_batch(self, bos, nearest_neighbor=True, match_threshold='auto',
+                      preprocess='zscore', n_jobs=1, tile_size=256, rbf_cutoff=None,
+                      reg=0, generator=False):
+        """
+        Reconstructs several brain objects, planning once per montage
+
+        Brain objects are grouped by montage: their electrode locations and
+        the electrodes that pass their filter.  Electrode matching, expansion
+        of the model and the reconstruction operator are computed once per
+        group, and reused for every brain object in it (e.g. sessions of the
+        same patient saved as separate files).  Each result matches
+        Model.predict on the corresponding brain object.
+
+        Parameters
+        ----------
+        bos : list of supereeg.Brain
+            The brain data objects that you want to predict
+
+        nearest_neighbor, match_threshold, preprocess, n_jobs, tile_size, rbf_cutoff, reg :
+            See Model.predict
+
+        generator : bool
+            If True, returns a generator of the reconstructed brain objects,
+            so only one of them need be in memory at a time.  Default False.
+
+        Returns
+        ----------
+        bos_p : list or generator of supereeg.Brain
+            New brain data objects with missing electrode locations filled in,
+            in the order of bos
+
+        """
+        if preprocess not in ('zscore', None,):
+            raise ValueError('Please set preprocess to either zscore or None.')
+
+        results = _predict_batch(self, bos, nearest_neighbor, match_threshold, preprocess,
+                                 n_jobs, tile_size, rbf_cutoff, reg)
+        if generator:
+            return results
+        return list(results)
 
     def update(self, data, measure='kurtosis', threshold=10, inplace=True,
-               locs=None, n=1):
+               locs=None, n=1, rbf_cutoff=None, n_jobs=1):
         """
         Update a model with new data.
 
@@ -232,6 +515,22 @@ class Model(object):
 
         inplace : bool
             Whether to run update in place or return a new model (default True).
+            A new model shares everything but the numerator and denominator
+            with this one, and those are only created when the new data are
+            added (copy-on-write), so the model is never deep-copied.
+
+        rbf_cutoff : int, float or None
+            If given, RBF weights between locations further apart than
+            rbf_cutoff (in mm) are treated as zero.  Default None.
+
+        n_jobs : int
+            Number of processes used to compute the new data's contributions
+            (default 1).  -1 uses all cpus.
+
+        Only the contributions of the new data are computed.  If the model
+        stores subject contributions (see store_subjects), those of new brain
+        objects are appended.  Low-rank factors (see set_low_rank) no longer
+        match the updated model, and are discarded.
 
         Returns
         ----------
@@ -246,16 +545,33 @@ class Model(object):
         if inplace:
             m = self
         else:
-            m = copy.deepcopy(self)
-        for d in data:
-            d = _format_data(d, m.locs, locs, n)
-            if isinstance(d, Brain):
-                num_corrmat_x, denom_corrmat_x, n_subs = _bo2model(d.get_filtered_bo(), m.locs, measure, threshold)
-            elif isinstance(d, Model):
-                num_corrmat_x, denom_corrmat_x, n_subs = _mo2model(d, m.locs)
-            m.numerator += num_corrmat_x
-            m.denominator += denom_corrmat_x
-            m.n_subs += n_subs
+            m = copy.copy(self)
+            m.meta = copy.copy(self.meta)
+            m._proj_cache = OrderedDict()
+            if self.subjects is not None:
+                m.subjects = list(self.subjects)
+        m._proj_cache.clear()
+        m.factors = None
+
+        delta_num = 0
+        delta_denom = 0
+        delta_subs = 0
+        for num_corrmat_x, denom_corrmat_x, n_subs, subjects in _contributions(data, m.locs, locs=locs, n=n,
+                                                                               rbf_cutoff=rbf_cutoff,
+                                                                               n_jobs=n_jobs):
+            delta_num = delta_num + num_corrmat_x
+            delta_denom = delta_denom + denom_corrmat_x
+            delta_subs += n_subs
+            if m.subjects is not None and subjects is not None:
+                m.subjects.extend(subjects)
+
+        if inplace and not m.packed:
+            m.numerator += delta_num
+            m.denominator += delta_denom
+        else:
+            m.numerator = m._numerator + _store_matrix(delta_num, m.dtype, m.packed)
+            m.denominator = m._denominator + _store_matrix(delta_denom, m.dtype, m.packed)
+        m.n_subs += delta_subs
 
         if not inplace:
             return m
@@ -341,13 +657,17 @@ class Model(object):
         """
 
         mo = {
-            'numerator' : self.numerator,
-            'denominator' : self.denominator,
+            'numerator' : self._numerator,
+            'denominator' : self._denominator,
             'locs' : self.locs,
             'n_subs' : self.n_subs,
             'meta' : self.meta,
             'date_created' : self.date_created
         }
+        if self.subjects is not None:
+            mo['subjects'] = self.subjects
+        if self.factors is not None:
+            mo['factors'] = self.factors
 
         if fname[-3:]!='.mo':
             fname+='.mo'
@@ -371,6 +691,13 @@ def _handle_superuser(self, numerator, denominator, locs, n_subs):
 
     self.n_subs = n_subs
 
+def _store_matrix(value, dtype, packed):
+    """Returns a numerator or denominator in the form the model stores it"""
+    value = np.asarray(value, dtype=dtype)
+    if packed and value.ndim == 2:
+        return _pack_triu(value)
+    return value
+
 def _create_locs(self, locs, template):
     """get locations from template, or from locs arg"""
     if locs is None:
@@ -383,27 +710,67 @@ def _create_locs(self, locs, template):
     if self.locs.shape[0]>1000:
         warnings.warn('Model locations exceed 1000, this may take a while. Go get a cup of coffee or brew some tea!')
 
-def _bo2model(bo, locs, measure, threshold):
-    """Returns numerator and denominator given a brain object"""
+def _contributions(data, model_locs, locs=None, n=1, rbf_cutoff=None, n_jobs=1):
+    """
+    Yields the contribution of each item of data to a model (see
+    _contribution), computing them in n_jobs processes, n_jobs at a time
+    """
+    if n_jobs == 1:
+        for d in data:
+            yield _contribution(d, model_locs, locs=locs, n=n, rbf_cutoff=rbf_cutoff)
+        return
+
+    batch_size = n_jobs if n_jobs > 0 else multiprocessing.cpu_count()
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for start in range(0, len(data), batch_size):
+            for result in parallel(delayed(_contribution)(d, model_locs, locs=locs, n=n, rbf_cutoff=rbf_cutoff)
+                                   for d in data[start:start + batch_size]):
+                yield result
+
+def _contribution(d, model_locs, locs=None, n=1, rbf_cutoff=None):
+    """
+    Returns the numerator, denominator and number of subjects that d adds to
+    a model, and the subject contributions it carries (None if unknown)
+    """
+    d = _format_data(d, model_locs, locs, n)
+    if isinstance(d, Brain):
+        subject = _bo2subject(d)
+        num_corrmat_x, denom_corrmat_x = _subject2model(subject, model_locs, rbf_cutoff=rbf_cutoff)
+        return num_corrmat_x, denom_corrmat_x, 1, [subject]
+    elif isinstance(d, Model):
+        num_corrmat_x, denom_corrmat_x, n_subs = _mo2model(d, model_locs, rbf_cutoff=rbf_cutoff)
+        return num_corrmat_x, denom_corrmat_x, n_subs, getattr(d, 'subjects', None)
+
+def _bo2subject(bo):
+    """Returns a subject's compact contribution: zscored correlation matrix and locations"""
     sub_corrmat = _get_corrmat(bo)
     np.fill_diagonal(sub_corrmat, 0)
-    sub_corrmat_z = _r2z(sub_corrmat)
-    sub_rbf_weights = _rbf(locs, bo.get_locs())
-    n, d = _expand_corrmat_fit(sub_corrmat_z, sub_rbf_weights)
-    return n, d, 1
+    return {'corrmat': _r2z(sub_corrmat), 'locs': np.asarray(bo.get_locs(), dtype=np.float64)}
+
+def _subject2model(subject, locs, rbf_cutoff=None):
+    """Expands a subject's contribution to the model locations"""
+    sub_rbf_weights = _rbf(locs, subject['locs'], cutoff=rbf_cutoff)
+    return _expand_corrmat_fit(subject['corrmat'], sub_rbf_weights)
 
-def _mo2model(mo, locs):
+def _mo2model(mo, locs, rbf_cutoff=None):
     """Returns numerator and denominator for model object"""
     if not isinstance(locs, pd.DataFrame):
         locs = pd.DataFrame(locs, columns=['x', 'y', 'z'])
     if locs.equals(mo.locs):
         return mo.numerator.copy(), mo.denominator.copy(), mo.n_subs
+    elif getattr(mo, 'subjects', None) is not None and len(mo.subjects) == mo.n_subs:
+        # the model's subjects are all stored, so expand each one exactly
+        n, d = 0, 0
+        for subject in mo.subjects:
+            sub_n, sub_d = _subject2model(subject, locs, rbf_cutoff=rbf_cutoff)
+            n, d = n + sub_n, d + sub_d
+        return n, d, mo.n_subs
     else:
         # if the locations are not equivalent, map input model into locs space
         with np.errstate(invalid='ignore'):
             sub_corrmat_z = np.divide(mo.numerator, mo.denominator)
         np.fill_diagonal(sub_corrmat_z, 0)
-        sub_rbf_weights = _rbf(locs, mo.locs)
+        sub_rbf_weights = _rbf(locs, mo.locs, cutoff=rbf_cutoff)
         n, d = _expand_corrmat_fit(sub_corrmat_z, sub_rbf_weights)
         return n, d, mo.n_subs
 
@@ -432,7 +799,7 @@ def _format_data(d, model_locs, new_locs=None, n_subs=1):
     else:
         raise TypeError("Did not recognize the type of one of your inputs to the model")
 
-def _force_update(mo, bo):
+def _force_update(mo, bo, rbf_cutoff=None):
 
     # get subject-specific correlation matrix
     sub_corrmat = _get_corrmat(bo)
@@ -444,7 +811,7 @@ def _force_update(mo, bo):
     sub_corrmat_z = _r2z(sub_corrmat)
 
     # get _rbf weights
-    sub__rbf_weights = _rbf(mo.locs, bo.get_locs())
+    sub__rbf_weights = _rbf(mo.locs, bo.get_locs(), cutoff=rbf_cutoff)
 
     #  get subject expanded correlation matrix
     num_corrmat_x, denom_corrmat_x = _expand_corrmat_fit(sub_corrmat_z, sub__rbf_weights)
@@ -459,6 +826,194 @@ def _force_update(mo, bo):
 # helper functions for predict
 ###################################
 
+def _predict_plan(self, bo, nearest_neighbor, match_threshold, force_update, n_jobs, tile_size, rbf_cutoff):
+    """
+    Filters bo's electrodes, matches them to the model and expands the model to
+    them.  Returns the processed brain object, the expanded correlation matrix
+    (None if all of bo's locations are in the model), and the label and
+    location of each row of the expanded matrix.
+    """
+    bo = bo.get_filtered_bo() #TODO: IMPLEMENT THIS in Brain.py -- should return a copy of the brain object with only the electrodes that pass the filtering, and with filter=None
+
+    # if match_threshold auto, ignore all electrodes whose distance from the
+    # nearest matching voxel is greater than the maximum voxel dimension
+    if nearest_neighbor:
+        bo = _near_neighbor(bo, self, match_threshold=match_threshold)
+
+    if self.locs.shape[0] > 1000:
+        warnings.warn('Model locations exceed 1000, this may take a while. Good time for a cup of coffee.')
+
+    # if True will update the model with subject's correlation matrix
+    if force_update:
+        model_corrmat_x = _force_update(self, bo, rbf_cutoff=rbf_cutoff)
+    else:
+        with np.errstate(invalid='ignore'):
+            model_corrmat_x = np.divide(self.numerator, self.denominator)
+
+    # model locations found in bo, and bo locations found in the model
+    bool_mask, bool_bo_mask, _ = _overlap_index(self.locs, bo.get_locs())
+    case = _which_case(bo, bool_mask)
+    if case is 'all_overlap':
+        return _all_overlap(bo, bool_bo_mask)
+    else:
+        # indices of the mask (where there is overlap
+        joint_model_inds = np.where(bool_mask)[0]
+        if case is 'no_overlap':
+            model_corrmat_x, loc_label, perm_locs = _no_overlap(self, bo, model_corrmat_x,
+                                                                n_jobs=n_jobs, tile_size=tile_size,
+                                                                rbf_cutoff=rbf_cutoff)
+        elif case is 'some_overlap':
+            model_corrmat_x, loc_label, perm_locs = _some_overlap(self, bo, model_corrmat_x, joint_model_inds,
+                                                                  n_jobs=n_jobs, tile_size=tile_size,
+                                                                  rbf_cutoff=rbf_cutoff,
+                                                                  bool_bo_mask=bool_bo_mask)
+        elif case is 'subset':
+            model_corrmat_x, loc_label, perm_locs = _subset(self, bo, model_corrmat_x, joint_model_inds)
+
+        model_corrmat_x = _z2r(model_corrmat_x)
+        np.fill_diagonal(model_corrmat_x, 0)
+
+        return bo, model_corrmat_x, loc_label, perm_locs
+
+def _all_overlap(bo, bool_bo_mask):
+    """Keeps bo's electrodes at model locations, when bo covers every model location"""
+    joint_bo_inds = np.where(bool_bo_mask)[0]
+    kurtosis = bo.kurtosis[joint_bo_inds]
+    bo.locs = bo.locs.iloc[joint_bo_inds]
+    bo.data = bo._values[:, joint_bo_inds]
+    bo.kurtosis = kurtosis
+    bo.label = np.array(bo.label)[joint_bo_inds].tolist()
+
+    return bo, None, bo.label, bo.locs
+
+def _low_rank_plan(self, bo, nearest_neighbor, match_threshold, rbf_cutoff, reg):
+    """
+    Filters bo's electrodes and matches them to the model as _predict_plan
+    does, then computes the reconstruction operator straight from the model's
+    low-rank factors.  Electrodes at model locations take the model's factor
+    rows; others take the rbf-weighted average of the model's factor rows.
+    Returns the processed brain object, the operator (None if all of bo's
+    locations are in the model), and the label and location of each
+    reconstructed and observed location.
+    """
+    bo = bo.get_filtered_bo()
+    if nearest_neighbor:
+        bo = _near_neighbor(bo, self, match_threshold=match_threshold)
+
+    bool_mask, bool_bo_mask, bo_to_model = _overlap_index(self.locs, bo.get_locs())
+    if all(bool_mask):
+        return _all_overlap(bo, bool_bo_mask)
+
+    vecs = self.factors['vecs']
+    vals = self.factors['vals']
+    obs_locs = bo.get_locs()
+    vecs_a = np.zeros((obs_locs.shape[0], vecs.shape[1]))
+    vecs_a[bool_bo_mask] = vecs[bo_to_model[bool_bo_mask]]
+    if not all(bool_bo_mask):
+        weights = _rbf(obs_locs.iloc[np.where(~bool_bo_mask)[0]], self.locs, cutoff=rbf_cutoff)
+        uncovered = np.asarray(weights.sum(axis=1)).ravel() == 0
+        if any(uncovered):
+            raise ValueError(str(np.sum(uncovered)) + ' electrode(s) have no model location within '
+                             'rbf_cutoff, so they cannot be mapped onto the low-rank factors.  '
+                             'Increase rbf_cutoff.')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            vecs_a[~bool_bo_mask] = np.asarray(weights.dot(vecs)) / np.asarray(weights.sum(axis=1)).reshape(-1, 1)
+
+    unknown = np.where(~bool_mask)[0]
+    proj = _low_rank_projection(vecs[unknown], vecs_a, vals, reg=reg)
+    loc_label = ['reconstructed'] * len(unknown) + ['observed'] * obs_locs.shape[0]
+    perm_locs = pd.concat([self.locs.iloc[unknown], obs_locs])
+
+    return bo, proj, loc_label, perm_locs
+
+def _montage_plan(self, fields, nearest_neighbor, match_threshold, n_jobs, tile_size, rbf_cutoff, reg):
+    """
+    Plans the reconstruction of a montage, given a dict of a brain object's
+    locs, kurtosis, kurtosis_threshold and filter.  Returns the processed
+    montage brain object, the recording's column of each observed location, the
+    reconstruction operator (None if all observed locations are in the model),
+    and the label and location of each reconstructed and observed location.
+    """
+    bo = _montage_brain(fields['locs'], fields['kurtosis'], fields['kurtosis_threshold'], fields['filter'])
+    if self.factors is not None:
+        bo, proj, loc_label, perm_locs = _low_rank_plan(self, bo, nearest_neighbor, match_threshold,
+                                                        rbf_cutoff, reg)
+    else:
+        bo, model_corrmat_x, loc_label, perm_locs = _predict_plan(self, bo, nearest_neighbor, match_threshold,
+                                                                  False, n_jobs, tile_size, rbf_cutoff)
+        proj = None
+        if model_corrmat_x is not None:
+            proj = _cached_projection(self, model_corrmat_x, bo.get_locs(), rbf_cutoff=rbf_cutoff, reg=reg)
+    obs_inds = bo._values.ravel().astype(int)
+    return bo, obs_inds, proj, loc_label, perm_locs
+
+def _montage_key(bo):
+    """Returns a key identifying bo's electrode locations and the electrodes passing its filter"""
+    return (np.ascontiguousarray(bo.locs, dtype=np.float64).tobytes(),
+            np.asarray(bo.filter_inds, dtype=bool).ravel().tobytes())
+
+def _model_hash(mo):
+    """Returns a hash of a model's locations, stored matrices and low-rank factors"""
+    h = hashlib.md5()
+    for x in [mo.locs, mo._numerator, mo._denominator]:
+        h.update(np.ascontiguousarray(x).tobytes())
+    if mo.factors is not None:
+        h.update(np.ascontiguousarray(mo.factors['vecs']).tobytes())
+        h.update(np.ascontiguousarray(mo.factors['vals']).tobytes())
+    return h.hexdigest()
+
+def _reconstruct_montage(bo, obs_inds, obs_locs, proj, loc_label, perm_locs, preprocess='zscore'):
+    """
+    Reconstructs bo from a montage plan: the recording's column of each
+    observed location, their locations, and the reconstruction operator (None
+    if all observed locations are in the model), with the label and location
+    of each reconstructed and observed location
+    """
+    observed = Brain(data=bo._values[:, obs_inds], locs=obs_locs, sessions=bo.sessions,
+                     sample_rate=bo.sample_rate, kurtosis=np.zeros(len(obs_inds)), filter=None)
+    if proj is None:
+        return Brain(data=observed._values, locs=observed.locs, sessions=observed.sessions,
+                     sample_rate=observed.sample_rate, label=loc_label)
+    activations = _timeseries_recon(observed, None, preprocess=preprocess, proj=proj)
+    return Brain(data=activations, locs=perm_locs, sessions=observed.sessions,
+                 sample_rate=observed.sample_rate, kurtosis=None, label=loc_label)
+
+def _predict_batch(self, bos, nearest_neighbor, match_threshold, preprocess, n_jobs, tile_size,
+                   rbf_cutoff, reg):
+    """Generator behind Model.predict_batch, planning each montage the first time it is seen"""
+    fields = ['locs', 'kurtosis', 'kurtosis_threshold', 'filter']
+    plans = {}
+    for bo in bos:
+        key = _montage_key(bo)
+        if key not in plans:
+            plans[key] = _montage_plan(self, {f: getattr(bo, f) for f in fields}, nearest_neighbor,
+                                       match_threshold, n_jobs, tile_size, rbf_cutoff, reg)
+        plan_bo, obs_inds, proj, loc_label, perm_locs = plans[key]
+        yield _reconstruct_montage(bo, obs_inds, plan_bo.locs, proj, loc_label, perm_locs,
+                                   preprocess=preprocess)
+
+def _montage_brain(locs, kurtosis, kurtosis_threshold, filter):
+    """
+    Returns a single-sample brain object whose data hold each electrode's
+    column index, so the electrode filtering, matching and permutation done by
+    _predict_plan can be followed without the recording's data
+    """
+    n_elecs = np.shape(locs)[0]
+    return Brain(data=np.arange(n_elecs, dtype=np.float64)[np.newaxis, :], locs=locs, kurtosis=kurtosis,
+                 kurtosis_threshold=kurtosis_threshold, filter=filter)
+
+def _cached_projection(self, K, locs, rbf_cutoff=None, reg=0):
+    """Returns Kba . pinv(Kaa) for the observed locs, from the model's LRU cache if possible"""
+    key = (np.ascontiguousarray(locs, dtype=np.float64).tobytes(), rbf_cutoff, reg)
+    if key in self._proj_cache:
+        proj = self._proj_cache.pop(key)
+    else:
+        proj = _recon_projection(K, locs.shape[0], reg=reg)
+    self._proj_cache[key] = proj
+    while len(self._proj_cache) > _PROJECTION_CACHE_SIZE:
+        self._proj_cache.popitem(last=False)
+    return proj
+
 def _which_case(bo, bool_mask):
     """Determine which predict scenario we are in"""
     if all(bool_mask):
@@ -471,13 +1026,14 @@ def _which_case(bo, bool_mask):
         return 'some_overlap'
 
 
-def _no_overlap(self, bo, model_corrmat_x):
+def _no_overlap(self, bo, model_corrmat_x, n_jobs=1, tile_size=256, rbf_cutoff=None):
     """ Compute model when there is no overlap """
     # expanded _rbf weights
-    model__rbf_weights = _rbf(pd.concat([self.locs, bo.get_locs()]), self.locs)
+    model__rbf_weights = _rbf(pd.concat([self.locs, bo.get_locs()]), self.locs, cutoff=rbf_cutoff)
 
     # get model expanded correlation matrix
-    num_corrmat_x, denom_corrmat_x = _expand_corrmat_predict(model_corrmat_x, model__rbf_weights)
+    num_corrmat_x, denom_corrmat_x = _expand_corrmat_predict(model_corrmat_x, model__rbf_weights,
+                                                             n_jobs=n_jobs, tile_size=tile_size)
 
     # divide the numerator and denominator
     with np.errstate(invalid='ignore'):
@@ -494,7 +1050,8 @@ def _no_overlap(self, bo, model_corrmat_x):
 def _subset(self, bo, model_corrmat_x, joint_model_inds):
     """ Compute model when bo is a subset of the model """
     # permute the correlation matrix so that the inds to reconstruct are on the right edge of the matrix
-    perm_inds = sorted(set(range(self.locs.shape[0])) - set(joint_model_inds)) + sorted(set(joint_model_inds))
+    perm_inds = np.concatenate([np.setdiff1d(np.arange(self.locs.shape[0]), joint_model_inds),
+                                np.unique(joint_model_inds)]).astype(int)
     model_corrmat_x = model_corrmat_x[:, perm_inds][perm_inds, :]
 
     # label locations as reconstructed or observed
@@ -505,40 +1062,40 @@ def _subset(self, bo, model_corrmat_x, joint_model_inds):
 
     return model_corrmat_x, loc_label, perm_locs
 
-def _some_overlap(self, bo, model_corrmat_x, joint_model_inds):
+def _some_overlap(self, bo, model_corrmat_x, joint_model_inds, n_jobs=1, tile_size=256, rbf_cutoff=None,
+                  bool_bo_mask=None):
     """ Compute model when there is some overlap """
 
     # get subject indices where subject locs do not overlap with model locs
-
-    bool_bo_mask= np.sum([(bo.get_locs() == y).all(1) for idy, y in self.locs.iterrows()], 0).astype(bool)
+    if bool_bo_mask is None:
+        bool_bo_mask = _overlap_index(self.locs, bo.get_locs())[1]
     disjoint_bo_inds = np.where(~bool_bo_mask)[0]
-    # d = cdist(bo.get_locs(), self.locs)
-    # disjoint_bo_inds = np.where(np.isclose(d, 0))[0]
 
     # permute the correlation matrix so that the inds to reconstruct are on the right edge of the matrix
-    perm_inds = sorted(set(range(self.locs.shape[0])) - set(joint_model_inds)) + sorted(set(joint_model_inds))
+    perm_inds_unknown = np.setdiff1d(np.arange(self.locs.shape[0]), joint_model_inds)
+    perm_inds = np.concatenate([perm_inds_unknown, np.unique(joint_model_inds)]).astype(int)
     model_permuted = model_corrmat_x[:, perm_inds][perm_inds, :]
 
     # permute the model locations (important for the _rbf calculation later)
     model_locs_permuted = self.locs.iloc[perm_inds]
 
     # permute the subject locations arranging them
-    bo_perm_inds = sorted(set(range(bo.get_locs().shape[0])) - set(disjoint_bo_inds)) + sorted(set(disjoint_bo_inds))
+    bo_perm_inds = np.concatenate([np.where(bool_bo_mask)[0], disjoint_bo_inds])
     sub_bo = bo.get_locs().iloc[disjoint_bo_inds]
 
     #TODO: would be safer to implement this using bo.get_locs(), bo.get_data()
+    kurtosis = bo.kurtosis[bo_perm_inds]
     bo.locs = bo.locs.iloc[bo_perm_inds]
-    bo.data = bo.data[bo_perm_inds]
-    bo.kurtosis = bo.kurtosis[bo_perm_inds]
+    bo.data = bo._values[:, bo_perm_inds]
+    bo.kurtosis = kurtosis
 
-    # permuted indices for unknown model locations
-    perm_inds_unknown = sorted(set(range(self.locs.shape[0])) - set(joint_model_inds))
     # expanded _rbf weights
     #model__rbf_weights = _rbf(pd.concat([model_locs_permuted, bo.locs]), model_locs_permuted)
-    model__rbf_weights = _rbf(pd.concat([model_locs_permuted, sub_bo]), model_locs_permuted)
+    model__rbf_weights = _rbf(pd.concat([model_locs_permuted, sub_bo]), model_locs_permuted, cutoff=rbf_cutoff)
 
     # get model expanded correlation matrix
-    num_corrmat_x, denom_corrmat_x = _expand_corrmat_predict(model_permuted, model__rbf_weights)
+    num_corrmat_x, denom_corrmat_x = _expand_corrmat_predict(model_permuted, model__rbf_weights,
+                                                             n_jobs=n_jobs, tile_size=tile_size)
 
     # divide the numerator and denominator
     with np.errstate(invalid='ignore'):
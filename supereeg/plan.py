@@ -0,0 +1,344 @@
+from __future__ import division
+from __future__ import print_function
+import time
+import numpy as np
+import pandas as pd
+import deepdish as dd
+from .brain import Brain
+from .model import Model, _montage_plan, _model_hash, _reconstruct_montage
+
+
+class PredictionPlan(object):
+    """
+    Precomputed reconstruction of a montage by a model
+
+    Predicting a brain object means matching its electrodes to the model,
+    expanding the model to them and inverting the observed locations'
+    correlation matrix, none of which depend on the recorded data.  A
+    prediction plan holds the result for one montage (a set of electrode
+    locations and the electrodes passing the kurtosis filter), so new data
+    from the same montage can be reconstructed with a single matrix product.
+    New data are matched on their electrode locations only, and the filter of
+    the planned brain object is applied to them, so no kurtosis is computed.
+    Plans can be saved and loaded, so a fixed montage is only planned once.
+
+    Parameters
+    ----------
+
+    model : supereeg.Model
+        The model used for the reconstruction
+
+    bo : supereeg.Brain
+        A brain object with the montage to plan for.  Its data are not used.
+
+    nearest_neighbor, match_threshold, n_jobs, tile_size, rbf_cutoff, reg :
+        See Model.predict
+
+    model_hash, locs, filter_inds, obs_inds, obs_locs, proj, label, perm_locs :
+        (Optional) The fields of a saved plan.  If used, model and bo are not
+        needed.
+
+    date created : str
+        Time created
+
+    Attributes
+    ----------
+
+    model_hash : str
+        Hash of the model the plan was computed from
+
+    locs : numpy.ndarray
+        Electrode locations of the montage
+
+    filter_inds : numpy.ndarray
+        Electrodes of the montage passing the kurtosis filter
+
+    obs_inds : numpy.ndarray
+        Column of the recording for each observed location
+
+    obs_locs : pandas.DataFrame
+        Observed locations, after matching to the model
+
+    proj : numpy.ndarray or None
+        Reconstruction operator (reconstructed x observed locations), or None
+        if all observed locations are in the model
+
+    label : list
+        'reconstructed' or 'observed', for each location of the reconstruction
+
+    perm_locs : pandas.DataFrame
+        Locations of the reconstruction
+
+    Returns
+    ----------
+
+    plan : supereeg.PredictionPlan
+        Instance of the prediction plan class
+
+    """
+
+    def __init__(self, model=None, bo=None, nearest_neighbor=True, match_threshold='auto',
+                 n_jobs=1, tile_size=256, rbf_cutoff=None, reg=0, model_hash=None,
+                 locs=None, filter_inds=None, obs_inds=None, obs_locs=None, proj=None,
+                 label=None, perm_locs=None, date_created=None):
+
+        if model is not None and bo is not None:
+            fields = {f: getattr(bo, f) for f in ['locs', 'kurtosis', 'kurtosis_threshold', 'filter']}
+            plan_bo, obs_inds, proj, label, perm_locs = _montage_plan(model, fields, nearest_neighbor,
+                                                                      match_threshold, n_jobs, tile_size,
+                                                                      rbf_cutoff, reg)
+            model_hash = _model_hash(model)
+            locs = np.asarray(bo.locs, dtype=np.float64)
+            filter_inds = np.asarray(bo.filter_inds, dtype=bool).ravel()
+            obs_locs = plan_bo.locs
+        elif any(v is None for v in [model_hash, locs, filter_inds, obs_inds, obs_locs, label, perm_locs]):
+            raise ValueError('Please pass either a model and a brain object, or the fields of a saved plan.')
+
+        self.model_hash = model_hash
+        self.locs = np.asarray(locs, dtype=np.float64)
+        self.filter_inds = np.asarray(filter_inds, dtype=bool).ravel()
+        self.obs_inds = np.asarray(obs_inds, dtype=int)
+        self.obs_locs = pd.DataFrame(np.asarray(obs_locs), columns=['x', 'y', 'z'])
+        self.proj = proj
+        self.label = list(label)
+        self.perm_locs = pd.DataFrame(np.asarray(perm_locs), columns=['x', 'y', 'z'])
+
+        if not date_created:
+            self.date_created = time.strftime("%c")
+        else:
+            self.date_created = date_created
+
+    def matches(self, data):
+        """
+        Checks whether the plan applies to a model or brain object
+
+        Parameters
+        ----------
+        data : supereeg.Model or supereeg.Brain
+            A model is matched by its hash, and a brain object by its electrode
+            locations
+
+        Returns
+        ----------
+        match : bool
+            True if the plan was computed from the model, or for the brain
+            object's montage
+
+        """
+        if isinstance(data, Model):
+            return _model_hash(data) == self.model_hash
+        return np.ascontiguousarray(data.locs, dtype=np.float64).tobytes() == self.locs.tobytes()
+
+    def predict(self, bo, preprocess='zscore'):
+        """
+        Reconstructs a brain object recorded with the plan's montage
+
+        Parameters
+        ----------
+        bo : supereeg.Brain
+            The brain data object that you want to predict.  The electrodes
+            filtered out when the plan was made are left out, whatever the
+            kurtosis of bo.
+
+        preprocess : 'zscore' or None
+            See Model.predict
+
+        Returns
+        ----------
+        bo_p : supereeg.Brain
+            New brain data object with missing electrode locations filled in,
+            as returned by Model.predict
+
+        """
+        if preprocess not in ('zscore', None,):
+            raise ValueError('Please set preprocess to either zscore or None.')
+        if not self.matches(bo):
+            raise ValueError('The electrodes of the brain object do not match those of the plan.')
+
+        return _reconstruct_montage(bo, self.obs_inds, self.obs_locs, self.proj, self.label,
+                                    self.perm_locs, preprocess=preprocess)
+
+    def save(self, fname, compression='blosc'):
+        """
+        Save method for the prediction plan
+
+        The plan will be saved as a 'pp' file, which is a dictionary containing
+        the elements of a prediction plan saved in the hd5 format using
+        `deepdish`.
+
+        Parameters
+        ----------
+
+        fname : str
+            A name for the file.  If the file extension (.pp) is not specified,
+            it will be appended.
+
+        compression : str
+            The kind of compression to use.  See the deepdish documentation for
+            options: http://deepdish.readthedocs.io/en/latest/api_io.html#deepdish.io.save
+
+        """
+
+        pp = {
+            'model_hash': self.model_hash,
+            'locs': self.locs,
+            'filter_inds': self.filter_inds,
+            'obs_inds': self.obs_inds,
+            'obs_locs': self.obs_locs,
+            'proj': self.proj,
+            'label': self.label,
+            'perm_locs': self.perm_locs,
+            'date_created': self.date_created,
+        }
+
+        if fname[-3:] != '.pp':
+            fname += '.pp'
+
+        dd.io.save(fname, pp, compression=compression)
+
+
+class OnlineReconstructor(object):
+    """
+    Reconstructs live data, a block of samples at a time
+
+    The reconstruction operator of a fixed montage is computed once (see
+    PredictionPlan).  Each block of samples passed to update is z-scored with
+    running means and variances of the observed data, which include the
+    block, and projected onto the model's locations; the reconstruction is
+    z-scored the same way.  The work per block depends only on the block size
+    and the montage, not on how much data have been seen.  With a single
+    block holding a whole session, the result matches Model.predict.
+
+    Parameters
+    ----------
+
+    plan : supereeg.PredictionPlan or supereeg.Model
+        The plan to reconstruct with, or a model to plan for bo with
+
+    bo : supereeg.Brain or None
+        If plan is a model, a brain object with the montage of the live data.
+        Its data are not used.
+
+    preprocess : 'zscore' or None
+        If 'zscore' (default), observed data are z-scored with their running
+        statistics.  If None, they are taken to be z-scored already.
+
+    **kwargs : keyword arguments
+        Passed to PredictionPlan if plan is a model
+
+    Attributes
+    ----------
+
+    plan : supereeg.PredictionPlan
+        The plan used for the reconstruction
+
+    locs : pandas.DataFrame
+        Locations of the reconstruction (reconstructed, then observed)
+
+    label : list
+        'reconstructed' or 'observed', for each location of the reconstruction
+
+    n_samples : int
+        Number of samples seen since the statistics were last reset
+
+    Returns
+    ----------
+
+    online : supereeg.OnlineReconstructor
+        Instance of the online reconstructor class
+
+    """
+
+    def __init__(self, plan, bo=None, preprocess='zscore', **kwargs):
+
+        if preprocess not in ('zscore', None,):
+            raise ValueError('Please set preprocess to either zscore or None.')
+
+        if isinstance(plan, Model):
+            if bo is None:
+                raise ValueError('Please pass a brain object with the montage to reconstruct.')
+            plan = PredictionPlan(plan, bo, **kwargs)
+
+        self.plan = plan
+        self.preprocess = preprocess
+        self.locs = plan.perm_locs
+        self.label = plan.label
+        if plan.proj is None:
+            self._proj_t = np.zeros((len(plan.obs_inds), 0))
+        else:
+            self._proj_t = np.ascontiguousarray(np.asarray(plan.proj).T)
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the running statistics, e.g. at the start of a new session
+        """
+        n_obs, n_recon = self._proj_t.shape
+        self.n_samples = 0
+        self._obs_stats = [np.zeros(n_obs), np.zeros(n_obs)]
+        self._recon_stats = [np.zeros(n_recon), np.zeros(n_recon)]
+
+    def calibrate(self, data):
+        """
+        Adds samples to the running statistics, without returning them
+
+        The samples are reconstructed as by update, since the running
+        statistics of the reconstruction depend on it, but the result is
+        discarded.
+
+        Parameters
+        ----------
+        data : numpy.ndarray or supereeg.Brain
+            Samples x electrodes of the montage (as recorded, before filtering)
+
+        """
+        self.update(data)
+
+    def update(self, data):
+        """
+        Reconstructs a block of samples
+
+        Parameters
+        ----------
+        data : numpy.ndarray or supereeg.Brain
+            Samples x electrodes of the montage (as recorded, before filtering)
+
+        Returns
+        ----------
+        results : numpy.ndarray
+            Samples x locations reconstruction, with the reconstructed locations
+            followed by the observed locations (see locs and label)
+
+        """
+        if isinstance(data, Brain):
+            data = data._values
+        x = np.atleast_2d(np.asarray(data, dtype=np.float64))[:, self.plan.obs_inds]
+
+        n = self.n_samples
+        if self.preprocess == 'zscore':
+            x = _running_zscore(x, self._obs_stats, n)
+        recon = _running_zscore(np.dot(x, self._proj_t), self._recon_stats, n)
+        self.n_samples = n + x.shape[0]
+        return np.hstack([recon, x])
+
+
+def _running_zscore(x, stats, n):
+    """
+    Merges the samples x features block x into the running mean and sum of
+    squared deviations in stats (over n previous samples), in place, and
+    returns x z-scored with the updated statistics
+    """
+    mean, m2 = stats
+    n_x = x.shape[0]
+    if n_x == 0:
+        return x
+    mean_x = x.mean(axis=0)
+    delta = mean_x - mean
+    total = n + n_x
+    m2 += ((x - mean_x) ** 2).sum(axis=0) + delta ** 2 * n * n_x / total
+    mean += delta * n_x / total
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (x - mean) / np.sqrt(m2 / total)
+    z[~np.isfinite(z)] = 0
+    return z
+
@@ -44,6 +44,77 @@ def test_bo_nsessions_int():
 def test_bo_kurtosis_list():
     assert isinstance(bo.kurtosis, np.ndarray)
 
+def test_bo_kurtosis_lazy():
+    bo_k = se.Brain(data=bo.data.values, locs=bo.locs, sample_rate=100, filter=None)
+    assert bo_k._kurtosis is None
+    assert np.allclose(bo_k.kurtosis, bo.kurtosis, equal_nan=True)
+    bo_k.data = bo.data * 2
+    assert bo_k._kurtosis is None
+
+def test_bo_get_data_cached():
+    bo_c = se.Brain(data=bo.data.values, locs=bo.locs, sample_rate=100, kurtosis=np.zeros(bo.locs.shape[0]))
+    assert bo_c._get_values() is bo_c._get_values()
+    assert bo_c.get_zscore_data() is bo_c.get_zscore_data()
+    assert np.shares_memory(bo_c.get_data().values, bo_c.data.values)
+    bo_c.kurtosis = np.arange(bo.locs.shape[0]) * 10
+    assert bo_c.get_data().shape[1] == 2
+    assert bo_c.get_filtered_bo().get_locs().shape[0] == 2
+
+def test_bo_get_data_read_only():
+    bo_c = se.Brain(data=np.random.rand(10, 3), locs=np.random.rand(3, 3), sample_rate=10, filter=None)
+    values = bo_c.data.values.copy()
+    d = bo_c.get_data()
+    d -= d.mean()
+    with pytest.raises(ValueError):
+        bo_c.get_data().values[0, 0] = 1
+    with pytest.raises(ValueError):
+        bo_c.get_zscore_data()[0, 0] = 1
+    locs = bo_c.get_locs()
+    locs.iloc[0, 0] = 1000
+    assert np.array_equal(bo_c.data.values, values)
+    assert np.array_equal(bo_c.get_data().values, values)
+    assert not np.any(bo_c.get_locs().values == 1000)
+
+def test_bo_array_backed():
+    values = np.random.rand(10, 3).astype(np.float32)
+    bo_a = se.Brain(data=values, locs=np.random.rand(3, 3), sessions=np.array([1] * 5 + [2] * 5),
+                    sample_rate=[10, 10])
+    assert bo_a._values is values
+    assert np.shares_memory(bo_a.data.values, values)
+    assert np.array_equal(bo_a._session_codes, [0] * 5 + [1] * 5)
+    assert bo_a.sessions.tolist() == [1] * 5 + [2] * 5
+
+def test_bo_sessions_resets_kurtosis():
+    values = np.random.randn(20, 2)
+    values[0, 0] = 100
+    bo_s = se.Brain(data=values, locs=np.random.rand(2, 3), sample_rate=10, kurtosis_threshold=6)
+    kurt = bo_s.kurtosis
+    assert bo_s.get_data().shape == (20, 1)
+    bo_s.sessions = np.array([1] * 2 + [2] * 18)
+    assert not np.allclose(bo_s.kurtosis, kurt)
+    assert bo_s.get_data().shape == (20, 2)
+
+def test_bo_iter_sessions():
+    values = np.random.rand(10, 3)
+    bo_s = se.Brain(data=values, locs=np.random.rand(3, 3), sessions=np.array([2] * 4 + [1] * 6),
+                    sample_rate=[10, 10], filter=None)
+    blocks = list(bo_s.iter_sessions())
+    assert [s for s, block in blocks] == [2, 1]
+    assert np.array_equal(blocks[1][1], values[4:])
+    assert np.shares_memory(blocks[1][1], values)
+
+def test_bo_iter_chunks():
+    values = np.random.rand(10, 3)
+    bo_s = se.Brain(data=values, locs=np.random.rand(3, 3), sessions=np.array([2] * 4 + [1] * 6),
+                    sample_rate=[10, 20], filter=None)
+    chunks = list(bo_s.iter_chunks(chunk_size=3))
+    assert [(c.start, c.session, c.sample_rate) for c in chunks] == [(0, 2, 10), (3, 2, 10), (4, 1, 20),
+                                                                     (7, 1, 20)]
+    assert np.array_equal(np.vstack([c.data for c in chunks]), values)
+    assert np.shares_memory(chunks[2].data, values)
+    windows = list(bo_s.iter_chunks(chunk_size=4, step=2))
+    assert [(c.start, c.data.shape[0]) for c in windows] == [(0, 4), (4, 4), (6, 4)]
+
 def test_samplerate_array():
     assert (bo.sample_rate is None) or (type(bo.sample_rate) is list)
 
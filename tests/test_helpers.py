@@ -7,12 +7,15 @@ import glob
 from supereeg.helpers import *
 from scipy.stats import kurtosis, zscore
 import os
+import pytest
 
 ## don't understand why i have to do this:
 from supereeg.helpers import _std, _gray, _resample_nii, _apply_by_file_index, _kurt_vals, _get_corrmat, _z2r, _r2z, _rbf, \
     _uniquerows, _expand_corrmat_fit, _expand_corrmat_predict, _chunk_bo, _timeseries_recon, _chunker, \
     _round_it, _corr_column, _normalize_Y, _near_neighbor, _vox_size, _count_overlapping, _resample, \
-    _nifti_to_brain, _brain_to_nifti
+    _nifti_to_brain, _brain_to_nifti, _recon_projection, _timeseries_recon_stream, _kurt_stats, _merge_kurt_stats, \
+    _kurt_from_stats, _greedy_match, _overlap_index, _pack_triu, _unpack_triu, _low_rank_factors, _low_rank_projection, \
+    _session_offsets
 
 locs = np.array([[-61., -77.,  -3.],
                  [-41., -77., -23.],
@@ -79,10 +82,29 @@ def test__kurt_vals_compare():
     kurts_2 = _kurt_vals(data[0])
     assert np.allclose(kurts_1, kurts_2)
 
+def test__kurt_vals_n_jobs():
+    assert np.allclose(_kurt_vals(bo, chunk_size=2, n_jobs=2), _kurt_vals(bo), equal_nan=True)
+
 def test_get_corrmat():
     corrmat = _get_corrmat(data[0])
     assert isinstance(corrmat, np.ndarray)
 
+def test_get_corrmat_chunked_float32():
+    corrmat = _get_corrmat(data[0])
+    corrmat_32 = _get_corrmat(data[0], chunk_size=3, dtype=np.float32)
+    assert np.allclose(corrmat, corrmat_32, atol=1e-4)
+
+def test_session_offsets():
+    assert np.array_equal(_session_offsets(np.array([0, 0, 1, 1, 1, 2])), [0, 2, 5, 6])
+    assert _session_offsets(np.array([0, 1, 0])) is None
+
+def test_pack_triu():
+    x = np.random.rand(6, 6)
+    x = x + x.T
+    packed = _pack_triu(x)
+    assert packed.shape == (21,)
+    assert np.array_equal(_unpack_triu(packed), x)
+
 def test_int_z2r():
     z = 1
     test_val = old_div((np.exp(2 * z) - 1), (np.exp(2 * z) + 1))
@@ -123,6 +145,31 @@ def test_rbf():
     assert isinstance(weights, np.ndarray)
     assert np.allclose(weights_same, np.eye(np.shape(weights_same)[0]))
 
+def test_rbf_cutoff():
+    weights = _rbf(locs, locs[:10])
+    weights_sparse = _rbf(locs, locs[:10], cutoff=30)
+    assert sparse.issparse(weights_sparse)
+    assert np.allclose(weights_sparse.toarray(), np.where(cdist(locs, locs[:10]) <= 30, weights, 0))
+    assert np.allclose(_rbf(locs, locs[:10], cutoff=1000).toarray(), weights)
+    with pytest.raises(ValueError):
+        _rbf(locs, locs[:10], cutoff=0)
+    with pytest.raises(ValueError):
+        _rbf(locs, locs[:10], eps=1)
+
+def test_expand_corrmat_sparse_weights():
+    sub_corrmat = _get_corrmat(bo)
+    np.fill_diagonal(sub_corrmat, 0)
+    sub_corrmat = _r2z(sub_corrmat)
+    weights = _rbf(test_model.locs, bo.locs, cutoff=40)
+    num_d, denom_d = _expand_corrmat_fit(sub_corrmat.copy(), weights.toarray())
+    num_s, denom_s = _expand_corrmat_fit(sub_corrmat.copy(), weights)
+    assert np.allclose(num_d, num_s)
+    assert np.allclose(denom_d, denom_s)
+    num_d, denom_d = _expand_corrmat_predict(sub_corrmat.copy(), weights.toarray())
+    num_s, denom_s = _expand_corrmat_predict(sub_corrmat.copy(), weights)
+    assert np.allclose(num_d, num_s)
+    assert np.allclose(denom_d, denom_s)
+
 def test_tal2mni():
     tal_vals = tal2mni(locs)
     assert isinstance(tal_vals, np.ndarray)
@@ -144,6 +191,19 @@ def test_expand_corrmat_fit():
     assert isinstance(expanded_denom_f, np.ndarray)
     assert np.shape(expanded_num_f)[0] == test_model.locs.shape[0]
 
+def test_expand_corrmat_fit_engines():
+    sub_corrmat = _get_corrmat(bo)
+    np.fill_diagonal(sub_corrmat, 0)
+    sub_corrmat = _r2z(sub_corrmat)
+    weights = _rbf(test_model.locs, bo.locs)
+    num_l, denom_l = _expand_corrmat_fit(sub_corrmat.copy(), weights, engine='loop')
+    num_v, denom_v = _expand_corrmat_fit(sub_corrmat.copy(), weights, engine='vectorized')
+
+    assert np.allclose(num_l, num_v)
+    assert np.allclose(denom_l, denom_v)
+    with pytest.raises(ValueError):
+        _expand_corrmat_fit(sub_corrmat.copy(), weights, engine='unknown')
+
 
 def test_expand_corrmat_predict():
     sub_corrmat = _get_corrmat(bo)
@@ -156,6 +216,17 @@ def test_expand_corrmat_predict():
     assert isinstance(expanded_denom_p, np.ndarray)
     assert np.shape(expanded_num_p)[0] == test_model.locs.shape[0]
 
+def test_expand_corrmat_predict_engines():
+    sub_corrmat = _get_corrmat(bo)
+    np.fill_diagonal(sub_corrmat, 0)
+    sub_corrmat = _r2z(sub_corrmat)
+    weights = _rbf(test_model.locs, bo.locs)
+    num_l, denom_l = _expand_corrmat_predict(sub_corrmat.copy(), weights, engine='loop')
+    num_t, denom_t = _expand_corrmat_predict(sub_corrmat.copy(), weights, n_jobs=2, tile_size=2)
+
+    assert np.allclose(num_l, num_t)
+    assert np.allclose(denom_l, denom_t)
+
 def test_expand_corrmats_same():
     sub_corrmat = _get_corrmat(bo)
     np.fill_diagonal(sub_corrmat, 0)  # <- possible failpoint
@@ -237,6 +308,25 @@ def test_model_compile(tmpdir):
     assert np.allclose(mo.numerator, test_model.numerator)
     assert np.allclose(mo.denominator, test_model.denominator)
 
+def test_model_compile_to_file(tmpdir):
+    p = tmpdir.mkdir("sub")
+    for m in range(len(data)):
+        model = se.Model(data=data[m], locs=locs)
+        model.save(fname=os.path.join(p.strpath, str(m)))
+    model_data = glob.glob(os.path.join(p.strpath, '*.mo'))
+    fname = se.model_compile(model_data, fname=os.path.join(p.strpath, 'compiled'), n_jobs=2, block_size=5)
+    mo = se.load(fname)
+    assert mo.n_subs == len(data)
+    assert np.allclose(mo.numerator, test_model.numerator)
+    assert np.allclose(mo.denominator, test_model.denominator)
+
+def test_model_compile_locs_mismatch(tmpdir):
+    p = tmpdir.mkdir("sub")
+    se.Model(data=data[0], locs=locs).save(fname=os.path.join(p.strpath, '0'))
+    se.Model(data=data[1], locs=locs[:10]).save(fname=os.path.join(p.strpath, '1'))
+    with pytest.raises(ValueError):
+        se.model_compile(sorted(glob.glob(os.path.join(p.strpath, '*.mo'))))
+
 # def test_chunk_bo():
 #     chunk = tuple([1,2,3])
 #     chunked_bo = _chunk_bo(bo_full, chunk)
@@ -251,6 +341,40 @@ def test_timeseries_recon():
     assert isinstance(recon, np.ndarray)
     assert np.shape(recon)[1] == np.shape(mo)[1]
 
+def test_timeseries_recon_proj():
+    mo = np.divide(test_model.numerator, test_model.denominator)
+    np.fill_diagonal(mo, 0)
+    s = mo.shape[0] - bo.get_locs().shape[0]
+    proj = _recon_projection(mo, bo.get_locs().shape[0])
+    assert np.allclose(proj, np.dot(mo[:s, s:], np.linalg.pinv(mo[s:, s:])))
+    recon = _timeseries_recon(bo, mo, 2)
+    recon_proj = _timeseries_recon(bo, mo, 2, proj=proj)
+    assert np.allclose(recon, recon_proj, equal_nan=True)
+
+def test_low_rank_projection():
+    x = np.random.rand(12, 12)
+    K = x + x.T
+    np.fill_diagonal(K, 0)
+    vecs, vals = _low_rank_factors(K, 12, method='eig')
+    proj = _low_rank_projection(vecs[:7], vecs[7:], vals)
+    assert np.allclose(proj, _recon_projection(K, 5))
+    vecs_r, vals_r = _low_rank_factors(K, 12, method='randomized', random_state=0)
+    assert np.allclose(np.dot(vecs_r * vals_r, vecs_r.T), K)
+
+def test_timeseries_recon_stream():
+    mo = np.divide(test_model.numerator, test_model.denominator)
+    np.fill_diagonal(mo, 0)
+    recon = _timeseries_recon(bo, mo, 2)
+    proj = _recon_projection(mo, bo.get_locs().shape[0])
+    obs = bo.get_data().as_matrix()
+    chunks = _timeseries_recon_stream(lambda start, stop: obs[start:stop], bo.sessions, proj, chunk_size=3)
+    assert np.allclose(recon, np.vstack([c for start, c in chunks]), equal_nan=True)
+
+def test_kurt_stats():
+    x = np.random.rand(20, 3)
+    stats = _merge_kurt_stats(_kurt_stats(x[:7]), _kurt_stats(x[7:]))
+    assert np.allclose(_kurt_from_stats(stats), kurtosis(x))
+
 def test_chunker():
     chunked = _chunker([1,2,3,4,5], 2)
     print(chunked)
@@ -269,6 +393,18 @@ def test_near_neighbor_int():
     new_bo = _near_neighbor(bo, test_model, match_threshold=10)
     assert isinstance(new_bo, se.Brain)
 
+def test_greedy_match():
+    model_locs = np.random.randn(50, 3) * 20
+    elec_locs = np.random.randn(20, 3) * 20
+    d = cdist(elec_locs, model_locs)
+    expected = np.zeros(20, dtype=int)
+    for i in range(20):
+        r, c = np.unravel_index(np.argmin(d), d.shape)
+        expected[r] = c
+        d[r] = np.inf
+        d[:, c] = np.inf
+    assert np.array_equal(_greedy_match(elec_locs, model_locs), expected)
+
 def test_vox_size():
     v_size = _vox_size(test_model.locs)
     assert isinstance(v_size, np.ndarray)
@@ -282,6 +418,14 @@ def test_count_overlapping():
     assert sum(bool_overlap)==bo.locs.shape[0]
     assert isinstance(bool_overlap, np.ndarray)
 
+def test_overlap_index():
+    x = np.array([[0., 0., 0.], [1., 1., 1.], [2., 2., 2.]])
+    y = np.array([[2., 2., 2.], [3., 3., 3.], [-0., 0., 0.]])
+    x_mask, y_mask, y_to_x = _overlap_index(x, y)
+    assert np.array_equal(x_mask, [True, False, True])
+    assert np.array_equal(y_mask, [True, False, True])
+    assert np.array_equal(y_to_x, [2, -1, 0])
+
 def test_resample():
     samp_data, samp_sess, samp_rate = _resample(bo, 8)
     assert isinstance(samp_data, pd.DataFrame)
@@ -289,6 +433,25 @@ def test_resample():
     assert isinstance(samp_rate, list)
     assert samp_rate==[8,8]
 
+def test_resample_anti_alias():
+    samp_data, samp_sess, samp_rate = _resample(bo, 8, anti_alias=True)
+    samp_data_p, samp_sess_p, samp_rate_p = _resample(bo, 8)
+    assert samp_data.shape == samp_data_p.shape
+    assert np.array_equal(samp_sess.values, samp_sess_p.values)
+    assert samp_rate == [8, 8]
+    samp_data, samp_sess, samp_rate = _resample(bo, 1000. / 1001)
+    up, down = _resample_factors(10, 1000. / 1001)
+    assert samp_rate == [10. * up / down] * 2
+    assert samp_data.shape[0] == 2 * _resampled_length(10, up, down)
+
+def test_resample_non_integer_upsampling():
+    ramp = se.Brain(data=np.arange(10.)[:, np.newaxis], locs=locs[:1], sample_rate=2, filter=None)
+    samp_data, samp_sess, samp_rate = _resample(ramp, 3)
+    assert samp_data.shape[0] == 15
+    assert samp_rate == [3]
+    assert np.isclose(samp_data.values.max(), 9)
+    assert np.allclose(samp_data.values[:14, 0], np.arange(14) * 2. / 3)
+
 def test_nifti_to_brain():
     b_d, b_l, b_h = _nifti_to_brain(_gray(20))
     assert isinstance(b_d, np.ndarray)
@@ -299,11 +462,39 @@ def test_brain_to_nifti():
     nii = _brain_to_nifti(bo, _gray(20))
     assert isinstance(nii, se.Nifti)
 
+def test_brain_to_nifti_memmap(tmpdir):
+    nii = _brain_to_nifti(bo, _gray(20))
+    p = tmpdir.mkdir("sub").join("example.nii")
+    nii_mm = _brain_to_nifti(bo, _gray(20), filepath=p.strpath, chunk_size=3)
+    assert isinstance(nii_mm, se.Nifti)
+    assert os.path.exists(p.strpath)
+    assert np.allclose(nii.get_data(), nii_mm.get_data())
+
+def test_nifti_key():
+    data = np.random.rand(4, 4, 4, 3)
+    data_2 = data.copy()
+    data_2[..., 1] += 1
+    assert _nifti_key(se.Nifti(data, affine=np.eye(4))) != _nifti_key(se.Nifti(data_2, affine=np.eye(4)))
+    assert _nifti_key(se.Nifti(data, affine=np.eye(4))) == _nifti_key(se.Nifti(data.copy(), affine=np.eye(4)))
+    assert _nifti_key(se.Nifti(data, affine=np.eye(4))) != _nifti_key(se.Nifti(data, affine=2 * np.eye(4)))
+
 def test_bo_nii_bo():
     nii = _brain_to_nifti(bo, _gray(20))
     b_d, b_l, b_h =_nifti_to_brain(nii)
     assert np.allclose(bo.get_locs(), b_l)
 
+def test_nifti_to_brain_locs():
+    data = np.zeros((4, 7, 3))
+    data[1, 5, 2] = 3.
+    data[3, 0, 1] = 5.
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-10., -20., -30.]
+    b_d, b_l, b_h = _nifti_to_brain(se.Nifti(data, affine=affine))
+    assert np.allclose(b_l, [[-8., -10., -26.], [-4., -20., -28.]])
+    assert np.allclose(b_d, [[3., 5.]])
+    b_d, b_l_cached, b_h = _nifti_to_brain(se.Nifti(data, affine=affine))
+    assert np.allclose(b_l, b_l_cached)
+
 def test_nii_bo_nii():
 
     bo_nii = se.Brain(_gray(20))
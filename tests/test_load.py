@@ -3,6 +3,7 @@ from builtins import range
 import supereeg as se
 import numpy as np
 import os
+import warnings
 import nibabel as nib
 import pytest
 
@@ -61,6 +62,39 @@ def test_bo_load(tmpdir):
     bo = se.load(os.path.join(p.strpath + '.bo'))
     assert isinstance(bo, se.Brain)
 
+def test_bo_load_mmap(tmpdir):
+    p = tmpdir.mkdir("sub").join("example")
+    test_bo.save(fname=p.strpath, compression=None)
+    bo = se.load(os.path.join(p.strpath + '.bo'), mmap_mode='r')
+    assert isinstance(bo, se.Brain)
+    assert np.allclose(bo.get_data(), test_bo.get_data())
+    assert np.allclose(bo.get_slice(sample_inds=[1, 2]).get_data(),
+                       test_bo.get_slice(sample_inds=[1, 2]).get_data())
+
+def test_bo_load_mmap_compressed(tmpdir):
+    # deepdish only compresses arrays of more than 300 elements
+    bo_big = se.simulate_model_bos(n_samples=100, sample_rate=10, locs=locs, sample_locs=n_elecs)
+    p = tmpdir.mkdir("sub").join("example")
+    bo_big.save(fname=p.strpath)
+    with pytest.warns(UserWarning):
+        bo = se.load(os.path.join(p.strpath + '.bo'), mmap_mode='r')
+    assert not os.path.exists(p.strpath + '.bo.npy')
+    assert np.allclose(bo.get_data(), bo_big.get_data())
+    cache = os.path.join(tmpdir.strpath, 'cache.npy')
+    bo = se.load(os.path.join(p.strpath + '.bo'), mmap_mode='r', mmap_cache=cache)
+    assert os.path.exists(cache)
+    assert np.allclose(bo.get_data(), bo_big.get_data())
+
+def test_bo_load_mmap_compressed_small(tmpdir):
+    p = tmpdir.mkdir("sub").join("example")
+    test_bo.save(fname=p.strpath)
+    cache = os.path.join(tmpdir.strpath, 'cache.npy')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        bo = se.load(os.path.join(p.strpath + '.bo'), mmap_mode='r', mmap_cache=cache)
+    assert not os.path.exists(cache)
+    assert np.allclose(bo.get_data(), test_bo.get_data())
+
 def test_mo_load(tmpdir):
     p = tmpdir.mkdir("sub").join("example")
     test_model.save(fname=p.strpath)
@@ -6,6 +6,7 @@ import supereeg as se
 import numpy as np
 import scipy
 import pytest
+import os
 
 # some example locations
 
@@ -49,11 +50,91 @@ def test_create_model_superuser():
     model = se.Model(numerator=numerator, denominator=denominator, locs=locs, n_subs=2)
     assert isinstance(model, se.Model)
 
+def test_create_model_rbf_cutoff():
+    model = se.Model(data=data[0:2], locs=locs)
+    model_sparse = se.Model(data=data[0:2], locs=locs, rbf_cutoff=1000)
+    assert np.allclose(model.numerator, model_sparse.numerator)
+    assert np.allclose(model.denominator, model_sparse.denominator)
+
 def test_model_predict():
     model = se.Model(data=data[0:2], locs=locs)
     bo = model.predict(data[0], nearest_neighbor=False)
     assert isinstance(bo, se.Brain)
 
+def test_model_predict_unfiltered_skips_kurtosis():
+    model = se.Model(data=data[0:2], locs=locs)
+    bo = se.Brain(data=data[2].data.values, locs=data[2].locs, sample_rate=10, filter=None)
+    assert bo.get_filtered_bo()._kurtosis is None
+    model.predict(bo, nearest_neighbor=False)
+    assert bo._kurtosis is None
+
+def test_model_predict_low_rank():
+    model = se.Model(data=data[0:2], locs=locs)
+    bo = model.predict(data[0], nearest_neighbor=False)
+    model.set_low_rank(rank=locs.shape[0], method='eig')
+    bo_low_rank = model.predict(data[0], nearest_neighbor=False)
+    assert np.allclose(bo.get_data(), bo_low_rank.get_data())
+    model.set_low_rank(rank=4, method='nystrom', random_state=0)
+    bo_nystrom = model.predict(data[0], nearest_neighbor=False)
+    assert bo_nystrom.get_data().shape == bo.get_data().shape
+    bo_off = se.Brain(data=data[0].data, locs=data[0].locs + 1, sample_rate=10)
+    model.set_low_rank(rank=locs.shape[0], method='eig')
+    bo_full = model.predict(bo_off, nearest_neighbor=False)
+    model_full = se.Model(data=data[0:2], locs=locs)
+    bo_expanded = model_full.predict(bo_off, nearest_neighbor=False)
+    assert bo_full.get_data().shape == bo_expanded.get_data().shape
+    assert np.all(np.isfinite(bo_full.get_data().values))
+    assert np.allclose(bo_full.get_locs(), bo_expanded.get_locs())
+    observed = np.array(bo_full.label) == 'observed'
+    assert np.allclose(bo_full.get_data().values[:, observed], bo_expanded.get_data().values[:, observed])
+    with pytest.raises(ValueError):
+        model.predict(bo_off, nearest_neighbor=False, rbf_cutoff=0.5)
+
+def test_model_predict_n_jobs():
+    model = se.Model(data=data[0:2], locs=locs)
+    bo_1 = model.predict(data[0], nearest_neighbor=False)
+    bo_2 = model.predict(data[0], nearest_neighbor=False, n_jobs=2, tile_size=1)
+    assert np.allclose(bo_1.get_data(), bo_2.get_data(), equal_nan=True)
+
+def test_model_predict_cached_projection():
+    model = se.Model(data=data[0:2], locs=locs)
+    bo_1 = model.predict(data[0], nearest_neighbor=False)
+    assert len(model._proj_cache) == 1
+    bo_2 = model.predict(data[0], nearest_neighbor=False)
+    assert len(model._proj_cache) == 1
+    assert np.allclose(bo_1.get_data(), bo_2.get_data(), equal_nan=True)
+    model.update(data[2])
+    assert len(model._proj_cache) == 0
+    model.predict(data[0], nearest_neighbor=False)
+    model.numerator = model.numerator * 2
+    assert len(model._proj_cache) == 0
+    model.predict(data[0], nearest_neighbor=False)
+    model.denominator = model.denominator * 2
+    assert len(model._proj_cache) == 0
+
+def test_model_predict_stream(tmpdir):
+    model = se.Model(data=data[0:2], locs=locs)
+    bo = model.predict(data[0], nearest_neighbor=False)
+    chunks = model.predict_stream(data[0], chunk_size=3, nearest_neighbor=False)
+    assert np.allclose(np.vstack([c for start, c in chunks]), bo.get_data(), equal_nan=True)
+    p = tmpdir.mkdir("sub")
+    data[0].save(fname=os.path.join(p.strpath, 'example'))
+    bo_s = model.predict_stream(os.path.join(p.strpath, 'example.bo'), out=os.path.join(p.strpath, 'recon'),
+                                chunk_size=3, nearest_neighbor=False)
+    assert isinstance(bo_s, se.Brain)
+    assert np.allclose(bo_s.get_data(), bo.get_data(), equal_nan=True)
+    assert np.allclose(bo_s.kurtosis, bo.kurtosis, equal_nan=True)
+
+def test_model_predict_batch():
+    model = se.Model(data=data[0:2], locs=locs)
+    bos = model.predict_batch([data[0], data[1], data[0]], nearest_neighbor=False)
+    assert len(bos) == 3
+    for d, bo_b in zip([data[0], data[1], data[0]], bos):
+        bo = model.predict(d, nearest_neighbor=False)
+        assert np.allclose(bo_b.get_data(), bo.get_data(), equal_nan=True)
+        assert np.allclose(bo_b.get_locs(), bo.get_locs())
+    assert len(model._proj_cache) == 2
+
 def test_model_predict_nn():
     model = se.Model(data=data[0:2], locs=locs)
     bo = model.predict(data[0], nearest_neighbor=True)
@@ -99,6 +180,56 @@ def test_model_update_not_inplace():
     mo = mo.update(data[0], inplace=False)
     assert isinstance(mo, se.Model)
 
+def test_create_model_float32_packed(tmpdir):
+    model = se.Model(data=data, locs=locs, dtype=np.float32, packed=True)
+    assert model.numerator.dtype == np.float32
+    assert model.numerator.shape == test_model.numerator.shape
+    assert np.allclose(model.numerator, test_model.numerator, atol=1e-4)
+    assert np.allclose(model.denominator, test_model.denominator, atol=1e-4)
+    assert model._numerator.ndim == 1
+    with pytest.raises(ValueError):
+        model.numerator[0, 1] = 1
+    updated = model.update(data[0], inplace=False)
+    assert updated.packed and model.n_subs + 1 == updated.n_subs
+    p = tmpdir.mkdir("sub").join("packed")
+    model.save(fname=p.strpath)
+    mo = se.load(p.strpath + '.mo')
+    assert mo.packed
+    assert mo.numerator.dtype == np.float32
+    assert np.allclose(mo.numerator, model.numerator)
+
+def test_create_model_n_jobs():
+    model = se.Model(data=data, locs=locs, n_jobs=2)
+    assert model.n_subs == test_model.n_subs
+    assert np.allclose(model.numerator, test_model.numerator)
+    assert np.allclose(model.denominator, test_model.denominator)
+
+def test_create_model_n_jobs_paths(tmpdir):
+    p = tmpdir.mkdir("sub")
+    paths = []
+    for i, bo in enumerate(data):
+        bo.save(fname=p.join("bo_" + str(i)).strpath)
+        paths.append(p.join("bo_" + str(i) + ".bo").strpath)
+    model = se.Model(data=paths, locs=locs, n_jobs=2)
+    assert np.allclose(model.numerator, test_model.numerator)
+
+def test_model_update_not_inplace_copy_on_write():
+    mo = se.Model(data=data[1:3], locs=locs, store_subjects=True)
+    numerator = mo.numerator.copy()
+    mo_2 = mo.update(data[0], inplace=False)
+    assert np.allclose(mo.numerator, numerator)
+    assert len(mo.subjects) == 2
+    assert len(mo_2.subjects) == 3
+    assert np.allclose(mo_2.numerator, test_model.numerator)
+    assert np.allclose(mo_2.denominator, test_model.denominator)
+
+def test_model_stored_subjects_new_locs():
+    mo = se.Model(data=data, locs=locs, store_subjects=True)
+    mo_locs = se.Model(mo, locs=locs[:8])
+    mo_direct = se.Model(data=data, locs=locs[:8])
+    assert np.allclose(mo_locs.numerator, mo_direct.numerator)
+    assert np.allclose(mo_locs.denominator, mo_direct.denominator)
+
 def test_model_update_with_model():
     mo = se.Model(data=data[1:3], locs=locs)
     mo = mo.update(mo, inplace=False)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import supereeg as se
+import numpy as np
+import pytest
+import os
+
+locs = np.array([[-61., -77.,  -3.],
+                 [-41., -77., -23.],
+                 [-21., -97.,  17.],
+                 [-21., -37.,  77.],
+                 [-21.,  63.,  -3.],
+                 [ -1., -37.,  37.],
+                 [ -1.,  23.,  17.],
+                 [ 19., -57., -23.],
+                 [ 19.,  23.,  -3.],
+                 [ 39., -57.,  17.],
+                 [ 39.,   3.,  37.],
+                 [ 59., -17.,  17.]])
+
+data = [se.simulate_model_bos(n_samples=10, sample_rate=10, locs=locs, sample_locs=5) for x in range(3)]
+test_model = se.Model(data=data[0:2], locs=locs)
+
+def test_create_plan():
+    plan = se.PredictionPlan(test_model, data[0], nearest_neighbor=False)
+    assert isinstance(plan, se.PredictionPlan)
+    assert plan.matches(test_model)
+    assert plan.matches(data[0])
+
+def test_plan_predict():
+    plan = se.PredictionPlan(test_model, data[0], nearest_neighbor=False)
+    bo = test_model.predict(data[0], nearest_neighbor=False)
+    bo_p = plan.predict(data[0])
+    assert np.allclose(bo_p.get_data(), bo.get_data(), equal_nan=True)
+    assert np.allclose(bo_p.get_locs(), bo.get_locs())
+
+def test_plan_predict_montage_mismatch():
+    plan = se.PredictionPlan(test_model, data[0], nearest_neighbor=False)
+    with pytest.raises(ValueError):
+        plan.predict(se.Brain(data=data[0].data, locs=data[0].locs + 1, sample_rate=10))
+
+def test_plan_predict_ignores_new_kurtosis():
+    plan = se.PredictionPlan(test_model, data[0], nearest_neighbor=False)
+    values = data[0].data.values.copy()
+    values[0, 0] = 1000
+    bo = se.Brain(data=values, locs=data[0].locs, sample_rate=10, kurtosis_threshold=3)
+    assert not all(bo.filter_inds)
+    assert plan.matches(bo)
+    assert plan.predict(bo).get_data().shape == plan.predict(data[0]).get_data().shape
+
+def test_plan_save_load(tmpdir):
+    plan = se.PredictionPlan(test_model, data[0], nearest_neighbor=False)
+    p = tmpdir.mkdir("sub").join("example")
+    plan.save(fname=p.strpath)
+    plan_l = se.load(os.path.join(p.strpath + '.pp'))
+    assert isinstance(plan_l, se.PredictionPlan)
+    assert plan_l.matches(test_model)
+    assert np.allclose(plan_l.predict(data[0]).get_data(), plan.predict(data[0]).get_data(), equal_nan=True)
+
+def test_online_reconstructor():
+    plan = se.PredictionPlan(test_model, data[0], nearest_neighbor=False)
+    bo = plan.predict(data[0])
+    online = se.OnlineReconstructor(plan)
+    assert np.allclose(online.update(data[0].data.values), bo.get_data(), equal_nan=True)
+    online.reset()
+    blocks = [online.update(data[0].data.values[i:i + 3]) for i in range(0, 10, 3)]
+    assert np.vstack(blocks).shape == bo.get_data().shape
+    assert online.n_samples == 10
+    n_obs = len(plan.obs_inds)
+    assert np.allclose(blocks[-1][-1, -n_obs:], bo.get_data().values[-1, -n_obs:])